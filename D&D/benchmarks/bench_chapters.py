@@ -0,0 +1,96 @@
+"""Koszt odczytu całej kroniki przed i po kompaktowaniu wiadomości do rozdziałów (chapters.compact_messages).
+
+Uruchomienie (z katalogu `D&D`):
+    python benchmarks/bench_chapters.py [--messages 5000] [--json wyniki.json]
+
+Gra rośnie turami (akcja gracza, narracja MG, komunikaty systemowe z jednym znacznikiem czasu), a po każdej
+turze działa kompaktowanie z parametrami aplikacji. Na końcu liczymy odczyty Firestore potrzebne do odtworzenia
+całej kroniki i sprawdzamy, że kolejność i treść wiadomości się nie zmieniły.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [BENCH_DIR, os.path.dirname(BENCH_DIR)]
+
+import fake_firestore  # noqa: E402
+
+STORE = fake_firestore.install()
+
+from game_core import chapters  # noqa: E402
+
+KEEP_LOOSE, MIN_BATCH = 60, 40  # jak COMPACTION_KEEP_LOOSE i COMPACTION_MIN_BATCH w aplikacji
+NARRATIVE = "Mgła gęstnieje nad traktem, a z oddali dobiega skrzypienie wozu i ujadanie psów. " * 6
+
+
+def play_turn(db, game_ref, rng, turn):
+    """Jedna tura jak w aplikacji; zwraca liczbę dodanych wiadomości."""
+    messages = game_ref.collection("messages")
+    messages.document().set({"role": "user", "content": f"Akcja {turn}: przeszukuję okolicę.", "timestamp": fake_firestore.SERVER_TIMESTAMP, "player_name": "Aria"})
+    live = messages.document()
+    live.set({"role": "assistant", "content": NARRATIVE, "timestamp": fake_firestore.SERVER_TIMESTAMP, "player_name": "Mistrz Gry", "streaming": False})
+    notices = rng.randint(0, 3)
+    batch = db.batch()
+    for i in range(notices):
+        batch.set(messages.document(f"{live.id}-{i:03d}"), {"role": "system", "content": f"*Aria otrzymuje {rng.randint(10, 300)} PD!*", "timestamp": fake_firestore.SERVER_TIMESTAMP, "player_name": "System"})
+    batch.commit()
+    return 2 + notices
+
+
+def replay(game_ref):
+    """Cała kronika: rozdziały w kolejności, potem luźne wiadomości (jak load_older_messages do samego początku)."""
+    archived = [m for chapter in game_ref.collection("chapters").order_by("first_timestamp").stream() for m in chapters.chapter_messages(chapter)]
+    loose = list(game_ref.collection("messages").order_by("timestamp").stream())
+    return [m.to_dict()["content"] for m in archived + loose], len({m.id for m in archived + loose})
+
+
+def measure_replay(game_ref):
+    with STORE.stats.measure() as delta:
+        started = time.perf_counter()
+        log, unique_ids = replay(game_ref)
+        elapsed = time.perf_counter() - started
+    assert unique_ids == len(log), "wiadomość występuje w kronice więcej niż raz"
+    return log, fake_firestore.OpStats.totals(delta)["read"], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="przybliżona liczba wiadomości w kampanii")
+    parser.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    args = parser.parse_args()
+
+    db = fake_firestore.Client(project="bench")
+    plain, compacted = db.collection("games").document("PLAIN"), db.collection("games").document("CHAPTR")
+    for game_ref in (plain, compacted): game_ref.set({"status": "active"})
+    turn, written, compaction = 0, 0, {"read": 0, "write": 0, "delete": 0}
+    while written < args.messages:
+        for game_ref in (plain, compacted): added = play_turn(db, game_ref, random.Random(turn), turn)
+        written += added
+        with STORE.stats.measure() as delta:
+            chapters.compact_messages(db, compacted, KEEP_LOOSE, MIN_BATCH)  # w aplikacji: po każdej turze MG
+        for op, n in fake_firestore.OpStats.totals(delta).items(): compaction[op] = compaction.get(op, 0) + n
+        turn += 1
+
+    plain_log, plain_reads, plain_s = measure_replay(plain)
+    compacted_log, compacted_reads, compacted_s = measure_replay(compacted)
+    assert plain_log == compacted_log, "kompaktowanie zmieniło treść lub kolejność kroniki"
+    chapter_count = sum(1 for path in STORE.docs if path.startswith("games/CHAPTR/chapters/"))
+    results = {
+        "messages": len(plain_log), "turns": turn, "chapters": chapter_count,
+        "replay_reads_plain": plain_reads, "replay_reads_chapters": compacted_reads,
+        "replay_s_plain": plain_s, "replay_s_chapters": compacted_s, "compaction_ops": compaction,
+    }
+    print(f"wiadomości: {results['messages']}, tur: {turn}, rozdziałów: {chapter_count}")
+    print(f"odtworzenie kroniki - bez rozdziałów: {plain_reads} odczytów ({plain_s * 1e3:.1f} ms), z rozdziałami: {compacted_reads} odczytów ({compacted_s * 1e3:.1f} ms)")
+    print(f"koszt kompaktowania przez całą grę: {compaction}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "chapters", "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Benchmark przepustowości parsera odpowiedzi MG (dm_parser.parse_response_from_dm).
+
+Uruchomienie (z katalogu `D&D`):
+    python benchmarks/bench_dm_parser.py [--json wyniki.json]
+
+Mierzy krótkie i bardzo długie odpowiedzi MG oraz odtworzenie całej kroniki gry (tysiące wiadomości).
+Przed pomiarem sprawdza poprawność: poprawne tagi znikają z narracji, tagi w złym formacie zostają,
+a tekst widoczny podczas strumieniowania jest równy narracji z parse_response_from_dm.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_core.dm_parser import StreamingTagParser, parse_response_from_dm  # noqa: E402
+
+NARRATIVE = (
+    "Drzwi karczmy skrzypią, gdy wchodzicie do środka. Zapach pieczonego dzika miesza się z dymem fajek, "
+    "a przy kominku stary bard stroi lutnię. Karczmarz unosi wzrok znad kufla i kiwa głową w waszą stronę. "
+)
+TAGS = [
+    "[IMG: a dimly lit medieval tavern, adventurers by the fireplace, warm light]",
+    "[TLO: karczma]",
+    "[ZADANIE: Odnajdź zaginionego kupca na trakcie do Srebrnego Jaru]",
+    '[WYBÓR: "Porozmawiaj z karczmarzem"; "Usiądź przy barze"; "Wyjdź na zewnątrz"]',
+    "[LOOT: Aria;Mikstura leczenia;Przywraca 2k4+2 PŻ]",
+    "[XP: Aria;150]",
+    "[NPC: Borin;Krasnoludzki kowal o rudej brodzie;dwarf blacksmith with a red beard, portrait]",
+    "[NPC_REMOVE: Tajemniczy nieznajomy]",
+    "[WALKA: START;Goblin;Goblin łucznik]",
+    "[MAPA: hand drawn fantasy map of a river valley with a tavern and a forest road]",
+]
+
+
+MALFORMED_TAGS = ["[LOOT: Aria;Miecz bez opisu]", "[XP: Aria;dużo]", "[XP: 150]", "[NPC: Borin]", "[NPC: Borin;kowal]"]
+
+
+def make_reply(rng, paragraphs, tags_per_paragraph):
+    parts = []
+    for _ in range(paragraphs):
+        parts.append(NARRATIVE)
+        parts.extend(rng.choice(TAGS) for _ in range(tags_per_paragraph))
+        parts.append("\n\n")
+    return "".join(parts)
+
+
+def make_log(rng, messages):
+    """Kronika jak w Firestore: gracze, MG i komunikaty systemowe na przemian."""
+    log = []
+    for i in range(messages):
+        if i % 3 == 2:
+            log.append(make_reply(rng, rng.randint(1, 4), rng.randint(1, 4)))
+        elif i % 3 == 1:
+            log.append(f"*Aria otrzymuje {rng.randint(10, 300)} PD!*")
+        else:
+            log.append("Przeszukuję pokój w poszukiwaniu ukrytych przejść.")
+    return log
+
+
+def bench(name, fn, payload_bytes, min_time=0.5):
+    fn()  # rozgrzewka
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time:
+        fn(); runs += 1
+    per_run = elapsed / runs
+    result = {"name": name, "runs": runs, "us_per_run": per_run * 1e6, "mb_per_s": payload_bytes / per_run / 1e6}
+    print(f"{name:<28} {result['us_per_run']:>12.1f} us/run {result['mb_per_s']:>10.1f} MB/s")
+    return result
+
+
+def stream_in_chunks(text, chunk_size=24):
+    parser = StreamingTagParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return parser.close()
+
+
+def check(condition, message):
+    if not condition: raise SystemExit(f"BŁĄD parsera: {message}")
+
+
+def verify(samples):
+    """Zachowanie parsera, które benchmark ma mierzyć - wyniki nie mają sensu, gdy któryś warunek nie działa."""
+    reply = parse_response_from_dm(NARRATIVE + "".join(TAGS))
+    check(reply.narrative == NARRATIVE.strip(), f"poprawne tagi zostały w narracji: {reply.narrative[len(NARRATIVE):]!r}")
+    check(reply.img_prompt and reply.bg_keyword == "karczma" and reply.quest_update and reply.map_prompt, "brak IMG/TLO/ZADANIE/MAPA")
+    check(len(reply.choices) == 3 and reply.loot_items and reply.xp_awards == [{"player": "Aria", "amount": 150}], "brak WYBÓR/LOOT/XP")
+    check(reply.npcs and reply.removed_npcs and reply.combat_updates, "brak NPC/NPC_REMOVE/WALKA")
+    for tag in MALFORMED_TAGS:
+        reply = parse_response_from_dm(f"{NARRATIVE}{tag}")
+        check(tag in reply.narrative, f"tag w złym formacie zniknął z narracji: {tag}")
+        check(not (reply.loot_items or reply.xp_awards or reply.npcs), f"tag w złym formacie dał efekt: {tag}")
+    for text in samples + [NARRATIVE + "".join(MALFORMED_TAGS + TAGS)]:
+        narrative = parse_response_from_dm(text).narrative
+        for chunk_size in (1, 7, 24):
+            check(stream_in_chunks(text, chunk_size).strip() == narrative, f"strumień (fragmenty po {chunk_size}) różni się od narracji")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--json", help="zapisz wyniki do pliku JSON (do śledzenia regresji)")
+    arg_parser.add_argument("--log-size", type=int, default=5000, help="liczba wiadomości w odtwarzanej kronice")
+    args = arg_parser.parse_args()
+
+    rng = random.Random(1234)
+    small = make_reply(rng, 3, 2)
+    large = make_reply(rng, 2000, 3)
+    log = make_log(rng, args.log_size)
+    log_bytes = sum(len(m.encode()) for m in log)
+    verify([small, large[:20000]] + log[:30])
+
+    results = [
+        bench("parse: krótka odpowiedź", lambda: parse_response_from_dm(small), len(small.encode())),
+        bench("parse: bardzo długa odpowiedź", lambda: parse_response_from_dm(large), len(large.encode())),
+        bench(f"parse: kronika x{args.log_size}", lambda: [parse_response_from_dm(m) for m in log], log_bytes),
+        bench("stream: krótka odpowiedź", lambda: stream_in_chunks(small), len(small.encode())),
+        bench("stream: bardzo długa odpowiedź", lambda: stream_in_chunks(large), len(large.encode())),
+    ]
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "dm_parser", "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
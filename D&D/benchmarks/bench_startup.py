@@ -0,0 +1,143 @@
+"""Zimny start: czas importu rdzenia gry (game_core) bez Streamlit i czas pierwszego renderu ekranu logowania.
+
+Uruchomienie (z katalogu `D&D`):
+    python benchmarks/bench_startup.py [--repeat 5] [--json wyniki.json]
+
+Każdy pomiar to świeży proces Pythona (pusty sys.modules, jak po restarcie kontenera). Raport: mediana i maksimum
+czasów oraz lista SDK (openai, httpx, google-cloud-firestore) wczytanych przy imporcie rdzenia i przed pierwszym
+renderem - oba powinny być puste. Gdy SDK nie są zainstalowane, ich import obsługują atrapy z tego katalogu.
+"""
+import argparse
+import importlib.abc
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+APP_PATH = os.path.join(APP_DIR, "streamlit.app.py")
+
+SDK_MODULES = ["openai", "httpx", "google.cloud.firestore", "google.oauth2.service_account"]
+CORE_MODULES = ["game_core.dm_parser", "game_core.sheets", "game_core.rules", "game_core.combat", "game_core.party",
+                "game_core.turns", "game_core.chapters", "game_core.character_pool", "game_core.clients"]
+FAKE_PARENTS = {"google.cloud", "google.oauth2", "google.cloud.firestore", "google.oauth2.service_account"}
+
+
+class FakeSdkFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Podstawia atrapy SDK dopiero przy próbie importu - obecność w sys.modules znaczy, że ktoś je zaimportował."""
+    def __init__(self):
+        self.installing = False
+
+    def find_spec(self, name, path=None, target=None):
+        if self.installing or not (name == "openai" or name in FAKE_PARENTS): return None
+        self.installing = True
+        try:
+            if name == "openai":
+                import fake_openai
+                fake_openai.install()
+            else:
+                import fake_firestore
+                fake_firestore.install()
+        finally:
+            self.installing = False
+        return importlib.util.spec_from_loader(name, self)
+
+    def create_module(self, spec): return sys.modules[spec.name]
+    def exec_module(self, module): pass
+
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def loaded_sdks():
+    return [name for name in SDK_MODULES if name in sys.modules]
+
+
+def probe_core():
+    started = time.perf_counter()
+    for name in CORE_MODULES: importlib.import_module(name)
+    return {"core_import_ms": (time.perf_counter() - started) * 1000, "sdk_loaded": loaded_sdks(), "streamlit_loaded": "streamlit" in sys.modules}
+
+
+def probe_login():
+    started = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    streamlit_ms = (time.perf_counter() - started) * 1000
+    session = AppTest.from_file(APP_PATH, default_timeout=60)
+    session.secrets["firebase_credentials"] = {"project_id": "bench"}
+    session.secrets["OPENAI_API_KEY"] = "bench"
+    session.secrets["character_pool_target"] = 0
+    render_started = time.perf_counter()
+    session.run()
+    render_ms = (time.perf_counter() - render_started) * 1000
+    if session.exception or not any(field.key == "player_login" for field in session.text_input):
+        raise RuntimeError(f"ekran logowania się nie wyrenderował: {session.exception}")
+    return {"streamlit_import_ms": streamlit_ms, "first_paint_ms": render_ms, "total_ms": (time.perf_counter() - started) * 1000, "sdk_loaded": loaded_sdks()}
+
+
+def run_probe(kind):
+    sys.path[:0] = [BENCH_DIR, APP_DIR]
+    if any(not installed(name) for name in ("openai", "google.cloud.firestore")): sys.meta_path.insert(0, FakeSdkFinder())
+    print(json.dumps(probe_core() if kind == "core" else probe_login()))
+
+
+def spawn(kind):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--probe", kind], cwd=APP_DIR, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def summarize(runs, keys):
+    summary = {key: {"median": statistics.median(run[key] for run in runs), "max": max(run[key] for run in runs)} for key in keys}
+    summary["sdk_loaded"] = sorted({name for run in runs for name in run["sdk_loaded"]})
+    return summary
+
+
+def run(args):
+    core = [spawn("core") for _ in range(args.repeat)]
+    login = [spawn("login") for _ in range(args.repeat)]
+    report = {"repeat": args.repeat,
+              "core": summarize(core, ["core_import_ms", "process_ms"]),
+              "login": summarize(login, ["streamlit_import_ms", "first_paint_ms", "total_ms", "process_ms"])}
+    report["core"]["streamlit_loaded"] = any(run["streamlit_loaded"] for run in core)
+    return report
+
+
+def print_report(report):
+    print(f"pomiary w świeżych procesach: {report['repeat']}x (mediana / maks., ms)")
+    for section, label in (("core", "import game_core"), ("login", "ekran logowania")):
+        print(f"\n{label}")
+        for key, value in report[section].items():
+            if isinstance(value, dict): print(f"  {key:<22}{value['median']:>10.1f}{value['max']:>10.1f}")
+        print(f"  wczytane SDK: {report[section]['sdk_loaded'] or 'brak'}")
+    print(f"\ngame_core wczytał Streamlit: {'tak' if report['core']['streamlit_loaded'] else 'nie'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="liczba świeżych procesów na pomiar")
+    parser.add_argument("--probe", choices=["core", "login"], help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="zapisz raport do pliku JSON (do porównywania między wersjami)")
+    args = parser.parse_args()
+    if args.probe:
+        run_probe(args.probe); return
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
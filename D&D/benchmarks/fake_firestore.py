@@ -0,0 +1,496 @@
+"""Firestore w pamięci - podmiana `google.cloud.firestore` dla testów obciążeniowych i benchmarków.
+
+Obsługuje to, czego używa aplikacja: dokumenty i kolekcje, zapytania (where/order_by/limit/kursory/count),
+WriteBatch, transakcje (@transactional), get_all, on_snapshot oraz transformacje SERVER_TIMESTAMP,
+Increment, ArrayUnion i ArrayRemove. Każdy odczyt, zapis i usunięcie trafia do liczników `STORE.stats`
+w podziale na kolekcję - tak jak naliczałby je Firestore.
+"""
+import copy
+import importlib
+import math
+import sys
+import threading
+import types
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+
+class _Sentinel:
+    def __init__(self, name): self.name = name
+    def __repr__(self): return self.name
+
+
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+
+
+class Increment:
+    def __init__(self, value): self.value = value
+
+
+class ArrayUnion:
+    def __init__(self, values): self.values = list(values)
+
+
+class ArrayRemove:
+    def __init__(self, values): self.values = list(values)
+
+
+class FieldFilter:
+    def __init__(self, field_path, op_string, value):
+        self.field_path, self.op_string, self.value = field_path, op_string, value
+
+
+class FieldPath:
+    def __init__(self, *parts): self.parts = parts
+    def to_api_repr(self): return ".".join(f"`{p}`" if not p.isidentifier() else p for p in self.parts)
+
+
+class NotFound(Exception):
+    pass
+
+
+class OpStats:
+    """Liczniki operacji (rodzaj, kolekcja) w stylu rozliczeń Firestore."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def record(self, op, collection_id, n=1):
+        with self._lock:
+            self.counts[(op, collection_id)] += n
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.counts)
+
+    @contextmanager
+    def measure(self):
+        """Zwraca Counter, który po wyjściu z bloku zawiera operacje wykonane wewnątrz bloku."""
+        delta, before = Counter(), self.snapshot()
+        yield delta
+        delta.update(self.snapshot())
+        delta.subtract(before)
+
+    @staticmethod
+    def totals(counts):
+        result = Counter()
+        for (op, _), n in counts.items(): result[op] += n
+        return result
+
+
+# --- Wartości pól ---
+
+def _split_field_path(path):
+    parts, current, quoted = [], "", False
+    for ch in path:
+        if ch == "`": quoted = not quoted
+        elif ch == "." and not quoted: parts.append(current); current = ""
+        else: current += ch
+    parts.append(current)
+    return parts
+
+
+def _get_field(data, path):
+    value = data
+    for part in _split_field_path(path):
+        if not isinstance(value, dict) or part not in value: raise KeyError(path)
+        value = value[part]
+    return value
+
+
+def _apply_transform(current, value, now):
+    if value is SERVER_TIMESTAMP: return now
+    if isinstance(value, Increment): return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        return result + [v for v in value.values if v not in result]
+    if isinstance(value, ArrayRemove):
+        return [v for v in (current if isinstance(current, list) else []) if v not in value.values]
+    if isinstance(value, dict):
+        return {k: _apply_transform(None, v, now) for k, v in value.items()}
+    return copy.deepcopy(value)
+
+
+def _set_field(data, path, value, now):
+    parts = _split_field_path(path) if isinstance(path, str) else list(path)
+    target = data
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict): target[part] = {}
+        target = target[part]
+    if value is DELETE_FIELD: target.pop(parts[-1], None)
+    else: target[parts[-1]] = _apply_transform(target.get(parts[-1]), value, now)
+
+
+def _merge(target, data, now):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict): _merge(target[key], value, now)
+        elif value is DELETE_FIELD: target.pop(key, None)
+        else: target[key] = _apply_transform(target.get(key), value, now)
+
+
+_TYPE_RANK = ((type(None), 0), (bool, 1), (int, 2), (float, 2), (datetime, 3), (str, 4))
+
+
+def _sort_value(value):
+    for kind, rank in _TYPE_RANK:
+        if isinstance(value, kind): return (rank, value)
+    return (9, repr(value))
+
+
+class _Desc:
+    def __init__(self, key): self.key = key
+    def __lt__(self, other): return self.key > other.key
+    def __gt__(self, other): return self.key < other.key
+    def __eq__(self, other): return self.key == other.key
+    def __le__(self, other): return self.key >= other.key
+    def __ge__(self, other): return self.key <= other.key
+
+
+def _collection_id(path):
+    parts = path.split("/")
+    return parts[-2] if len(parts) % 2 == 0 else parts[-1]
+
+
+# --- Magazyn ---
+
+class _Store:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.transaction_lock = threading.RLock()
+        self.stats = OpStats()
+        self._listeners = []
+        self._clock = datetime.now(timezone.utc)
+
+    def reset(self):
+        with self.lock:
+            self.docs.clear(); self._listeners.clear(); self.stats = OpStats()
+
+    def now(self):
+        self._clock = max(datetime.now(timezone.utc), self._clock + timedelta(microseconds=1))
+        return self._clock
+
+    def commit(self, writes):
+        """Atomowo stosuje listę zapisów (op, path, data, merge) z jednym znacznikiem czasu."""
+        with self.lock:
+            now = self.now()
+            for op, path, _, _ in writes:
+                if op == "update" and path not in self.docs: raise NotFound(path)
+            for op, path, data, merge in writes:
+                if op == "delete":
+                    self.docs.pop(path, None)
+                    self.stats.record("delete", _collection_id(path))
+                    continue
+                if op == "set" and not merge:
+                    self.docs[path] = {}
+                doc = self.docs.setdefault(path, {})
+                if op == "update":
+                    for field_path, value in data.items(): _set_field(doc, field_path, value, now)
+                else:
+                    _merge(doc, data, now)
+                self.stats.record("write", _collection_id(path))
+            listeners = list(self._listeners)
+        touched = {path for _, path, _, _ in writes}
+        for listener in listeners: listener.notify(touched)
+        return now
+
+    def add_listener(self, listener):
+        with self.lock: self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self._listeners: self._listeners.remove(listener)
+
+
+STORE = _Store()
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, read_time=None):
+        self.reference, self._data, self.read_time = reference, data, read_time
+
+    @property
+    def id(self): return self.reference.id
+
+    @property
+    def exists(self): return self._data is not None
+
+    def to_dict(self): return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None: raise KeyError(field_path)
+        return copy.deepcopy(_get_field(self._data, field_path))
+
+
+class _Watch:
+    def __init__(self, store, target, callback):
+        self.store, self.target, self.callback = store, target, callback
+        self._last = None
+        store.add_listener(self)
+        self._deliver()
+
+    def _deliver(self):
+        docs = self.target._watch_results()
+        current = {doc.id: doc._data for doc in docs}
+        if self._last is not None and current == self._last: return
+        changed = [doc_id for doc_id, data in current.items() if self._last is None or self._last.get(doc_id) != data]
+        self.store.stats.record("read", self.target._collection_id, max(1, len(changed)) if self._last is None else len(changed))
+        self._last = current
+        self.callback(docs, changed, datetime.now(timezone.utc))
+
+    def notify(self, touched_paths):
+        if any(self.target._watches_path(path) for path in touched_paths): self._deliver()
+
+    def unsubscribe(self): self.store.remove_listener(self)
+
+
+class DocumentReference:
+    def __init__(self, store, path):
+        self._store, self.path = store, path
+
+    @property
+    def id(self): return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self): return CollectionReference(self._store, self.path.rsplit("/", 1)[0])
+
+    @property
+    def _collection_id(self): return _collection_id(self.path)
+
+    def __eq__(self, other): return isinstance(other, DocumentReference) and other.path == self.path
+    def __hash__(self): return hash(self.path)
+
+    def collection(self, name): return CollectionReference(self._store, f"{self.path}/{name}")
+
+    def _snapshot(self):
+        with self._store.lock:
+            return DocumentSnapshot(self, copy.deepcopy(self._store.docs.get(self.path)))
+
+    def get(self, field_paths=None, transaction=None):
+        self._store.stats.record("read", self._collection_id)
+        return self._snapshot()
+
+    def set(self, document_data, merge=False):
+        return self._store.commit([("set", self.path, document_data, merge)])
+
+    def update(self, field_updates):
+        return self._store.commit([("update", self.path, field_updates, False)])
+
+    def delete(self):
+        return self._store.commit([("delete", self.path, None, False)])
+
+    def on_snapshot(self, callback): return _Watch(self._store, self, callback)
+
+    def _watch_results(self): return [self._snapshot()]
+
+    def _watches_path(self, path): return path == self.path
+
+
+class AggregationResult:
+    def __init__(self, alias, value): self.alias, self.value = alias, value
+
+
+class _CountQuery:
+    def __init__(self, query, alias): self.query, self.alias = query, alias
+
+    def get(self, transaction=None):
+        n = len(self.query._results())
+        self.query._store.stats.record("read", self.query._collection_id, max(1, math.ceil(n / 1000)))
+        return [[AggregationResult(self.alias or "count", n)]]
+
+
+class Query:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(self, store, collection_path, filters=(), orders=(), limit=None, limit_to_last=False, cursor=None):
+        self._store, self._path = store, collection_path
+        self._filters, self._orders = tuple(filters), tuple(orders)
+        self._limit, self._limit_to_last, self._cursor = limit, limit_to_last, cursor
+
+    def _copy(self, **changes):
+        fields = dict(filters=self._filters, orders=self._orders, limit=self._limit, limit_to_last=self._limit_to_last, cursor=self._cursor)
+        fields.update(changes)
+        return Query(self._store, self._path, **fields)
+
+    @property
+    def _collection_id(self): return _collection_id(self._path)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is None: filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count): return self._copy(limit=count, limit_to_last=False)
+    def limit_to_last(self, count): return self._copy(limit=count, limit_to_last=True)
+    def start_after(self, document): return self._copy(cursor=("after", document))
+    def start_at(self, document): return self._copy(cursor=("at", document))
+    def end_before(self, document): return self._copy(cursor=("before", document))
+    def count(self, alias=None): return _CountQuery(self, alias)
+
+    def _matches(self, data):
+        for f in self._filters:
+            try:
+                value = _get_field(data, f.field_path)
+            except KeyError:
+                return False
+            op, expected = f.op_string, f.value
+            if op in ("<", "<=", ">", ">="):
+                if _sort_value(value)[0] != _sort_value(expected)[0]: return False
+            if op == "==" and not value == expected: return False
+            if op == "!=" and not value != expected: return False
+            if op == "<" and not value < expected: return False
+            if op == "<=" and not value <= expected: return False
+            if op == ">" and not value > expected: return False
+            if op == ">=" and not value >= expected: return False
+            if op == "in" and value not in expected: return False
+            if op == "array_contains" and not (isinstance(value, list) and expected in value): return False
+        return True
+
+    def _sort_key(self, doc_id, data):
+        key = []
+        for field_path, direction in self._orders:
+            value = _sort_value(_get_field(data, field_path))
+            key.append(_Desc(value) if direction == self.DESCENDING else value)
+        last_desc = bool(self._orders) and self._orders[-1][1] == self.DESCENDING
+        key.append(_Desc(doc_id) if last_desc else doc_id)
+        return tuple(key)
+
+    def _results(self):
+        prefix_depth = self._path.count("/") + 1
+        with self._store.lock:
+            candidates = [(path, data) for path, data in self._store.docs.items()
+                          if path.rsplit("/", 1)[0] == self._path and path.count("/") == prefix_depth]
+            rows = []
+            for path, data in candidates:
+                if not self._matches(data): continue
+                try:
+                    rows.append((self._sort_key(path.rsplit("/", 1)[1], data), path, copy.deepcopy(data)))
+                except KeyError:
+                    continue  # Firestore pomija dokumenty bez pola użytego w order_by
+        rows.sort(key=lambda row: row[0])
+        if self._cursor:
+            kind, snapshot = self._cursor
+            cursor_key = self._sort_key(snapshot.id, snapshot._data)
+            if kind == "after": rows = [r for r in rows if r[0] > cursor_key]
+            elif kind == "at": rows = [r for r in rows if r[0] >= cursor_key]
+            elif kind == "before": rows = [r for r in rows if r[0] < cursor_key]
+        if self._limit is not None:
+            rows = rows[-self._limit:] if self._limit_to_last else rows[:self._limit]
+        return [DocumentSnapshot(DocumentReference(self._store, path), data) for _, path, data in rows]
+
+    def stream(self, transaction=None):
+        results = self._results()
+        self._store.stats.record("read", self._collection_id, max(1, len(results)))
+        return iter(results)
+
+    def get(self, transaction=None): return list(self.stream(transaction))
+
+    def on_snapshot(self, callback): return _Watch(self._store, self, callback)
+
+    def _watch_results(self): return self._results()
+
+    def _watches_path(self, path): return path.rsplit("/", 1)[0] == self._path
+
+
+class CollectionReference(Query):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+
+    @property
+    def id(self): return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        if document_id is None: document_id = _auto_id()
+        return DocumentReference(self._store, f"{self._path}/{document_id}")
+
+    def add(self, document_data):
+        ref = self.document()
+        return ref.set(document_data), ref
+
+
+_auto_id_counter = [0]
+_auto_id_lock = threading.Lock()
+
+
+def _auto_id():
+    with _auto_id_lock:
+        _auto_id_counter[0] += 1
+        return f"auto{_auto_id_counter[0]:016d}"
+
+
+class WriteBatch:
+    def __init__(self, store):
+        self._store, self._writes = store, []
+
+    def set(self, reference, document_data, merge=False): self._writes.append(("set", reference.path, document_data, merge))
+    def update(self, reference, field_updates): self._writes.append(("update", reference.path, field_updates, False))
+    def delete(self, reference): self._writes.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._store.commit(writes) if writes else None
+
+
+class Transaction(WriteBatch):
+    """Transakcja serializowana blokadą magazynu - w pamięci nie ma konfliktów do ponawiania."""
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference): return iter([ref_or_query.get(transaction=self)])
+        return ref_or_query.stream(transaction=self)
+
+    def get_all(self, references):
+        return iter([ref.get(transaction=self) for ref in references])
+
+
+def transactional(to_wrap):
+    def wrapper(transaction, *args, **kwargs):
+        with transaction._store.transaction_lock:
+            result = to_wrap(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return wrapper
+
+
+class Client:
+    def __init__(self, credentials=None, project=None, store=None):
+        self.project = project
+        self._store = store or STORE
+
+    def collection(self, name): return CollectionReference(self._store, name)
+    def document(self, path): return DocumentReference(self._store, path)
+    def batch(self): return WriteBatch(self._store)
+    def transaction(self, **kwargs): return Transaction(self._store)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        return iter([ref.get() for ref in references])
+
+    def close(self): pass
+
+
+def _namespace_package(name):
+    """Prawdziwy pakiet przestrzeni nazw, jeśli jest (np. google.protobuf dla Streamlit), inaczej pusty pakiet."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        package = types.ModuleType(name)
+        package.__path__ = []
+        sys.modules[name] = package
+        return package
+
+
+def install():
+    """Rejestruje ten moduł jako `google.cloud.firestore` (i atrapę `google.oauth2.service_account`) w sys.modules."""
+    this = sys.modules[__name__]
+    google, cloud, oauth2 = (_namespace_package(name) for name in ("google", "google.cloud", "google.oauth2"))
+    service_account = types.ModuleType("google.oauth2.service_account")
+    service_account.Credentials = types.SimpleNamespace(from_service_account_info=lambda info, **kwargs: info)
+    google.cloud, google.oauth2 = cloud, oauth2
+    cloud.firestore = this
+    oauth2.service_account = service_account
+    sys.modules["google.cloud.firestore"] = this
+    sys.modules["google.oauth2.service_account"] = service_account
+    return STORE
@@ -0,0 +1,122 @@
+"""Skryptowana atrapa modułu `openai` z konfigurowalnymi opóźnieniami - do testów obciążeniowych bez sieci.
+
+Odpowiedzi MG krążą po zestawie typowych narracji z tagami; `{player}` zastępujemy imieniem postaci
+z ostatniej wiadomości gracza, żeby nagrody i PD trafiały do prawdziwych członków drużyny.
+Opcjonalnie część wywołań kończy się błędem 429 albo 503 (error_rate), jak przy przeciążonym API.
+"""
+import base64
+import itertools
+import random
+import sys
+import threading
+import time
+import types
+
+# Najmniejszy poprawny PNG (1x1) - magazyn obrazów zapisuje go jak prawdziwy portret.
+TINY_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+DM_SCRIPT = [
+    "Wchodzicie do zadymionej karczmy. {player} zauważa przy kominku starego barda. [TLO: karczma] [IMG: smoky medieval tavern, bard by the fireplace] [NPC: Bard Elric;Stary bard z lutnią;old bard with a lute, portrait] [WYBÓR: \"Porozmawiaj z bardem\"; \"Zamów piwo\"]",
+    "Bard opowiada o zaginionym kupcu ze Srebrnego Jaru. [ZADANIE: Odnajdź zaginionego kupca] [XP: {player};50]",
+    "Na trakcie zza drzew wyskakują gobliny! [WALKA: START;Goblin;Goblin łucznik] [IMG: goblins ambush on a forest road]",
+    "{player} powala ostatniego goblina. W sakwie znajdujecie miksturę. [WALKA: KONIEC] [LOOT: {player};Mikstura leczenia;Przywraca 2k4+2 PŻ] [XP: {player};300]",
+    "Docieracie do rozwidlenia dróg. [MAPA: hand drawn map of a river valley with a forked road] [TLO: las] [NPC_REMOVE: Bard Elric]",
+]
+
+
+class APIStatusError(Exception):
+    """Błędy HTTP w kształcie wyjątków SDK (status_code, response.headers)."""
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(headers={"retry-after": str(retry_after)} if retry_after is not None else {})
+
+
+class RateLimitError(APIStatusError): pass
+
+
+class InternalServerError(APIStatusError): pass
+
+
+class OpenAIStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {"chat": 0, "chat_stream": 0, "images": 0, "errors": 0}
+        self.latencies = {"chat": [], "images": []}
+
+    def record_error(self):
+        with self._lock:
+            self.calls["errors"] += 1
+
+    def record(self, kind, seconds, streamed=False):
+        with self._lock:
+            self.calls["chat_stream" if streamed else kind] += 1
+            self.latencies[kind].append(seconds)
+
+
+class ScriptedOpenAI:
+    """Atrapa API (chat.completions.create, images.generate) z opóźnieniami: pierwszy token, kolejne fragmenty, obraz."""
+    def __init__(self, first_token_latency=0.5, chunk_latency=0.02, chunk_size=24, image_latency=3.0, error_rate=0.0, script=DM_SCRIPT):
+        self.first_token_latency, self.chunk_latency, self.chunk_size = first_token_latency, chunk_latency, chunk_size
+        self.image_latency, self.error_rate = image_latency, error_rate
+        self._errors = random.Random(0)
+        self.stats = OpenAIStats()
+        self._script = itertools.cycle(script)
+        self._script_lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_completion))
+        self.images = types.SimpleNamespace(generate=self._generate_image)
+
+    def _next_reply(self, messages):
+        player = "Bohater"
+        for message in reversed(messages):
+            if message.get("role") == "user" and ":" in message.get("content", ""):
+                player = message["content"].split(":", 1)[0].strip() or player
+                break
+        with self._script_lock:
+            return next(self._script).format(player=player)
+
+    def _maybe_fail(self):
+        with self._script_lock:
+            roll = self._errors.random()
+        if roll >= self.error_rate: return
+        self.stats.record_error()
+        if roll < self.error_rate / 2: raise RateLimitError("Rate limit reached", 429, retry_after=0)
+        raise InternalServerError("The server is overloaded", 503)
+
+    def _create_completion(self, model=None, messages=(), stream=False, **kwargs):
+        self._maybe_fail()
+        text = self._next_reply(messages) if len(messages) > 1 else "Imię: Aria\nKlasa: Mag\nRasa: Elf\nPunkty Życia: 40\nHistoria: Uczennica z wieży.\n[PORTRET: elf mage portrait]"
+        started = time.perf_counter()
+        if not stream:
+            time.sleep(self.first_token_latency + self.chunk_latency * (len(text) // self.chunk_size))
+            self.stats.record("chat", time.perf_counter() - started)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))])
+        return self._stream(text, started)
+
+    def _stream(self, text, started):
+        time.sleep(self.first_token_latency)
+        for i in range(0, len(text), self.chunk_size):
+            if i: time.sleep(self.chunk_latency)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text[i:i + self.chunk_size]))])
+        self.stats.record("chat", time.perf_counter() - started, streamed=True)
+
+    def _generate_image(self, model=None, prompt="", size="1024x1024", response_format="url", **kwargs):
+        self._maybe_fail()
+        started = time.perf_counter()
+        time.sleep(self.image_latency)
+        self.stats.record("images", time.perf_counter() - started)
+        item = types.SimpleNamespace(b64_json=base64.b64encode(TINY_PNG).decode(), url="https://example.invalid/image.png", revised_prompt=prompt)
+        return types.SimpleNamespace(data=[item])
+
+
+def install(**latencies):
+    """Rejestruje atrapę jako moduł `openai` w sys.modules i zwraca ją (z licznikami w `.stats`)."""
+    fake = ScriptedOpenAI(**latencies)
+    module = types.ModuleType("openai")
+    module.api_key = None
+    module.chat, module.images = fake.chat, fake.images
+    module.OpenAI = lambda **options: fake  # klient per proces (get_openai_pool) dostaje tę samą atrapę
+    module.APIStatusError, module.RateLimitError, module.InternalServerError = APIStatusError, RateLimitError, InternalServerError
+    module.scripted = fake
+    sys.modules["openai"] = module
+    return fake
@@ -0,0 +1,168 @@
+"""Test obciążeniowy aplikacji bez Firestore i OpenAI: N gier x M graczy na atrapach w pamięci.
+
+Uruchomienie (z katalogu `D&D`):
+    python benchmarks/load_test.py --games 3 --players 4 --turns 5 --refreshes 10 [--json wyniki.json]
+
+Każdy gracz to osobna sesja Streamlit (streamlit.testing.v1.AppTest) uruchamiająca prawdziwy skrypt aplikacji.
+Scenariusz: create_game, join_game pozostałych graczy, tury z send_message (chat_input) i cykle odświeżenia
+main_gui każdej sesji. Raport: odczyty/zapisy Firestore na odświeżenie i na turę (z podziałem na kolekcje),
+percentyle czasu tury, wywołania OpenAI oraz szczytowe zużycie pamięci.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+APP_PATH = os.path.join(APP_DIR, "streamlit.app.py")
+sys.path[:0] = [BENCH_DIR, APP_DIR]
+
+import fake_firestore  # noqa: E402
+import fake_openai  # noqa: E402
+
+CLASSES = ["Łotrzyk", "Mag", "Wojownik", "Kleryk"]
+
+
+def percentile(values, q):
+    if not values: return 0.0
+    if len(values) == 1: return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def seed_character(db, account, name, klasa):
+    db.collection("players").document(account).collection("characters").document(name).set({
+        "imię": name, "klasa": klasa, "rasa": "Człowiek", "punkty_życia": "30", "historia": "Postać testowa.",
+        "portrait_prompt": f"{klasa} portrait", "xp": 0, "level": 1,
+    })
+
+
+def new_session(account, character, image_dir, timeout):
+    from streamlit.testing.v1 import AppTest
+    session = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    session.secrets["firebase_credentials"] = {"project_id": "load-test"}
+    session.secrets["OPENAI_API_KEY"] = "load-test"
+    session.secrets["image_store_dir"] = image_dir
+    session.secrets["character_pool_target"] = 0  # postacie zasiewamy wprost; producent puli zaburzyłby liczniki OpenAI
+    session.session_state["player_name"] = account
+    session.session_state["selected_character_name"] = character
+    return session.run()
+
+
+def click(session, label):
+    next(button for button in session.button if button.label == label).click()
+    return session.run()
+
+
+def take_action(session, choices, text):
+    """Akcja gracza jak w przeglądarce: wpis w chat_input, a gdy MG dał wybór - kliknięcie pierwszej opcji."""
+    if choices:
+        return click(session, choices[0])
+    return session.chat_input[0].set_value(text).run()
+
+
+class Recorder:
+    """Zbiera operacje Firestore i czasy dla jednego rodzaju kroku (odświeżenie, tura, dołączenie...)."""
+    def __init__(self):
+        self.samples, self.by_collection = [], Counter()
+
+    def measure(self, store, step):
+        with store.stats.measure() as delta:
+            started = time.perf_counter()
+            step()
+            elapsed = time.perf_counter() - started
+        totals = fake_firestore.OpStats.totals(delta)
+        self.samples.append({"seconds": elapsed, "read": totals["read"], "write": totals["write"], "delete": totals["delete"]})
+        self.by_collection.update({f"{op}:{collection}": n for (op, collection), n in delta.items() if n})
+
+    def summary(self):
+        seconds = [s["seconds"] for s in self.samples]
+        result = {"count": len(self.samples), "p50_s": percentile(seconds, 50), "p90_s": percentile(seconds, 90), "p99_s": percentile(seconds, 99)}
+        for op in ("read", "write", "delete"):
+            values = [s[op] for s in self.samples]
+            result[f"{op}_mean"] = statistics.fmean(values) if values else 0.0
+            result[f"{op}_max"] = max(values, default=0)
+        result["by_collection"] = dict(sorted(self.by_collection.items()))
+        return result
+
+
+def run(args):
+    store = fake_firestore.install()
+    openai_fake = fake_openai.install(first_token_latency=args.chat_latency, chunk_latency=args.chunk_latency, image_latency=args.image_latency, error_rate=args.error_rate)
+    db = fake_firestore.Client(project="load-test")
+    image_dir = tempfile.mkdtemp(prefix="dd-load-images-")
+    recorders = {name: Recorder() for name in ("create", "join", "refresh", "turn")}
+
+    tracemalloc.start()
+    for g in range(args.games):
+        sessions = []
+        for p in range(args.players):
+            account, character = f"gracz{g}_{p}", f"Bohater{g}_{p}"
+            seed_character(db, account, character, CLASSES[p % len(CLASSES)])
+            sessions.append(new_session(account, character, image_dir, args.timeout))
+
+        host = sessions[0]
+        recorders["create"].measure(store, lambda: click(host, "Stwórz Grę"))
+        game_id = host.session_state["game_id"]
+        for guest in sessions[1:]:
+            next(field for field in guest.text_input if field.label == "Wpisz ID Gry").set_value(game_id)
+            recorders["join"].measure(store, lambda guest=guest: click(guest, "Dołącz do Gry"))
+
+        for turn in range(args.turns):
+            actor = sessions[turn % len(sessions)]
+            action = f"Akcja {turn}: rozglądam się uważnie."
+            choices = db.collection("games").document(game_id).get().to_dict().get("choices") or []  # poza pomiarem tury
+            recorders["turn"].measure(store, lambda: take_action(actor, choices, action))
+            for _ in range(max(1, args.refreshes // max(1, args.turns))):
+                for session in sessions:
+                    recorders["refresh"].measure(store, session.run)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "config": vars(args),
+        "steps": {name: recorder.summary() for name, recorder in recorders.items()},
+        "openai_calls": openai_fake.stats.calls,
+        "documents_in_store": len(store.docs),
+        "peak_memory_mb": peak_bytes / 1e6,
+    }
+
+
+def print_report(report):
+    print(f"{'krok':<10}{'n':>6}{'p50 s':>9}{'p90 s':>9}{'p99 s':>9}{'odcz./krok':>12}{'max':>6}{'zapisy/krok':>13}")
+    for name, step in report["steps"].items():
+        print(f"{name:<10}{step['count']:>6}{step['p50_s']:>9.3f}{step['p90_s']:>9.3f}{step['p99_s']:>9.3f}"
+              f"{step['read_mean']:>12.1f}{step['read_max']:>6}{step['write_mean']:>13.1f}")
+    print(f"\nOdczyty na odświeżenie wg kolekcji: {report['steps']['refresh']['by_collection']}")
+    print(f"Wywołania OpenAI: {report['openai_calls']}")
+    print(f"Dokumenty w magazynie: {report['documents_in_store']}, szczyt pamięci: {report['peak_memory_mb']:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=2)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=5, help="tury MG na grę")
+    parser.add_argument("--refreshes", type=int, default=10, help="cykle odświeżenia każdej sesji na grę")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="opóźnienie pierwszego tokenu (s)")
+    parser.add_argument("--chunk-latency", type=float, default=0.01, help="opóźnienie kolejnych fragmentów strumienia (s)")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="czas generowania obrazu (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="odsetek wywołań OpenAI kończących się błędem 429/503 (0-1)")
+    parser.add_argument("--timeout", type=float, default=120, help="limit czasu jednego przebiegu skryptu w AppTest (s)")
+    parser.add_argument("--json", help="zapisz raport do pliku JSON (do porównywania między wersjami)")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
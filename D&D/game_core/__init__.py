@@ -0,0 +1,5 @@
+"""Rdzeń gry bez Streamlit: parsowanie odpowiedzi MG i kart postaci, zasady rozwoju, walka, logika tury i klienci.
+
+Moduły importują się bez SDK Firestore i OpenAI (patrz game_core.clients), więc z rdzenia mogą korzystać
+aplikacja, workery w tle i benchmarki. Ten plik celowo niczego nie importuje - każdy moduł wczytuje się osobno.
+"""
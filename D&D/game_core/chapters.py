@@ -0,0 +1,126 @@
+"""Rozdziały kroniki: stare wiadomości gry spakowane po kilkaset w dokumentach `games/{id}/chapters/{id}`.
+
+Odczyt kampanii z 5000 wiadomości to kilkanaście dokumentów rozdziałów zamiast 5000 osobnych wiadomości.
+Wiadomości z rozdziałów udają migawki Firestore (id, to_dict), więc kronika i kontekst MG czytają je tak samo
+jak luźne dokumenty z `messages`. Kolejność w obrębie kroniki to (timestamp, id), jak w zapytaniach Firestore.
+"""
+from .clients import firestore
+from .turns import turn_lease_expired
+
+CHAPTER_MAX_MESSAGES = 450   # zapis rozdziału + usunięcia oryginałów mieszczą się w limicie 500 operacji partii
+CHAPTER_MAX_BYTES = 900_000  # zapas poniżej limitu 1 MiB na dokument Firestore
+MESSAGE_OVERHEAD_BYTES = 96  # nazwy pól, znacznik czasu i id w szacunku rozmiaru wiadomości
+
+
+class ArchivedMessage:
+    """Wiadomość z rozdziału w interfejsie migawki dokumentu (id, exists, to_dict)."""
+    __slots__ = ("id", "_data")
+    archived = True
+    exists = True
+
+    def __init__(self, message):
+        data = dict(message)
+        self.id = data.pop("id")
+        self._data = data
+
+    def to_dict(self): return dict(self._data)
+
+
+def message_key(doc):
+    return (doc.to_dict().get("timestamp"), doc.id)
+
+
+def message_size(data):
+    return MESSAGE_OVERHEAD_BYTES + sum(len(key) + len(str(value).encode("utf-8")) for key, value in data.items())
+
+
+def pack_chapters(docs, max_messages=CHAPTER_MAX_MESSAGES, max_bytes=CHAPTER_MAX_BYTES):
+    """Dzieli migawki wiadomości (rosnąco) na kolejne rozdziały w granicach liczby wiadomości i rozmiaru dokumentu."""
+    chapters, current, size = [], [], 0
+    for doc in docs:
+        cost = message_size(doc.to_dict())
+        if current and (len(current) >= max_messages or size + cost > max_bytes):
+            chapters.append(current); current, size = [], 0
+        current.append(doc); size += cost
+    if current: chapters.append(current)
+    return chapters
+
+
+def chapter_id(docs):
+    return docs[0].id  # id pierwszej wiadomości: dopisanie do otwartego rozdziału nadpisuje ten sam dokument
+
+
+def is_live(message):
+    """Narracja MG w toku; "streaming" starsze niż dzierżawa tury to ślad po zerwanej sesji, czyli narracja zakończona."""
+    return bool(message.get("streaming")) and not turn_lease_expired(message.get("timestamp"))
+
+
+def chapter_document(docs):
+    messages = [{**{key: value for key, value in doc.to_dict().items() if key != "streaming"}, "id": doc.id} for doc in docs]
+    return {"messages": messages, "count": len(messages), "first_timestamp": messages[0].get("timestamp"), "last_timestamp": messages[-1].get("timestamp")}
+
+
+def chapter_messages(chapter_snapshot):
+    return [ArchivedMessage(message) for message in (chapter_snapshot.to_dict() or {}).get("messages", [])]
+
+
+def compact_messages(db, game_ref, keep_loose, min_batch):
+    """Pakuje najstarsze luźne wiadomości (poza keep_loose najnowszymi) w rozdziały i usuwa oryginały.
+
+    Nowe wiadomości dopisujemy do ostatniego, niepełnego rozdziału, więc rozdziały są pełne niezależnie od tego,
+    jak często działa kompaktowanie. Każdy rozdział zapisujemy w jednej partii razem z usunięciem oryginałów
+    i znacznikiem `chapters_until` na dokumencie gry. Dzięki temu czytelnicy nigdy nie widzą wiadomości
+    podwójnie ani nie tracą ich w połowie pakowania. Zwraca liczbę przeniesionych wiadomości.
+    """
+    messages_ref, chapters_ref = game_ref.collection("messages"), game_ref.collection("chapters")
+    excess = messages_ref.count().get()[0][0].value - keep_loose
+    if excess < min_batch: return 0
+    docs = list(messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(excess + 1).stream())
+    first_kept = docs.pop() if len(docs) > excess else None
+    # Nie rozdzielamy wiadomości z tym samym znacznikiem czasu (np. komunikaty jednej tury) ani narracji na żywo.
+    if first_kept is not None:
+        boundary = first_kept.to_dict().get("timestamp")
+        while docs and docs[-1].to_dict().get("timestamp") == boundary: docs.pop()
+    live = next((i for i, doc in enumerate(docs) if is_live(doc.to_dict())), None)
+    if live is not None: del docs[live:]
+    if not docs: return 0
+    newest_chapter = list(chapters_ref.order_by("last_timestamp", direction=firestore.Query.DESCENDING).limit(1).stream())
+    open_messages = chapter_messages(newest_chapter[0]) if newest_chapter else []  # pełny rozdział zostanie pominięty niżej
+    moved = 0
+    for chapter in pack_chapters(open_messages + docs):
+        chapter_data = chapter_document(chapter)
+        loose = [doc for doc in chapter if not getattr(doc, "archived", False)]
+        if not loose: continue
+        batch = db.batch()
+        batch.set(chapters_ref.document(chapter_id(chapter)), chapter_data)
+        for doc in loose: batch.delete(doc.reference)
+        batch.update(game_ref, {"chapters_until": chapter_data["last_timestamp"]})
+        batch.commit()
+        moved += len(loose)
+    return moved
+
+
+def archived_before(game_ref, boundary, count):
+    """Co najmniej `count` wiadomości z rozdziałów starszych niż boundary (rosnąco), jeśli tyle ich jest.
+
+    Zwraca całe wczytane rozdziały (bez nowszych od boundary), by wywołujący mógł je buforować - jeden odczyt na rozdział.
+    """
+    boundary_key = message_key(boundary)
+    chapters = game_ref.collection("chapters").where(filter=firestore.FieldFilter("first_timestamp", "<=", boundary_key[0]))
+    collected = []
+    for chapter in chapters.order_by("first_timestamp", direction=firestore.Query.DESCENDING).stream():
+        collected[:0] = [message for message in chapter_messages(chapter) if message_key(message) < boundary_key]
+        if len(collected) >= count: break
+    return collected
+
+
+def archived_after(game_ref, after_timestamp, count):
+    """Do `count` wiadomości z rozdziałów nowszych niż after_timestamp (None = od początku gry), rosnąco."""
+    chapters = game_ref.collection("chapters")
+    if after_timestamp is not None:
+        chapters = chapters.where(filter=firestore.FieldFilter("last_timestamp", ">", after_timestamp))
+    collected = []
+    for chapter in chapters.order_by("last_timestamp", direction=firestore.Query.ASCENDING).stream():
+        collected += [message for message in chapter_messages(chapter) if after_timestamp is None or message.to_dict().get("timestamp") > after_timestamp]
+        if len(collected) >= count: break
+    return collected[:count]
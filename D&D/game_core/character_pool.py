@@ -0,0 +1,104 @@
+"""Pula gotowych postaci: karty z portretem generowane w tle, rozdawane graczom jedną transakcją.
+
+Dokumenty `character_pool/{id}` to kompletne karty (te same pola co `players/{konto}/characters/{imię}`)
+z dodatkowym `pooled_at`. Wątek producenta dopełnia pulę do zadanej liczby kart na klasę. Koncept gracza
+dopasowujemy po klasie, rasie i słowach z historii; przejęcie karty to w jednej transakcji odczyt, zapis
+postaci u gracza i usunięcie z puli, więc dwie sesje nigdy nie dostaną tej samej karty.
+"""
+import threading
+
+from .clients import firestore
+from .sheets import CLASS_PATTERNS, RACE_PATTERNS, detect, is_complete, tokenize
+
+POOL_COLLECTION = "character_pool"
+MATCH_CANDIDATES = 20  # ile kart z puli oceniamy przy jednym dopasowaniu
+CLAIM_ATTEMPTS = 3     # kolejne najlepsze karty, gdy inna sesja przejęła nam kartę sprzed nosa
+MIN_MATCH_SCORE = 3    # bez klasy w koncepcie: np. rasa i wspólne słowo z historii; słabsze dopasowanie -> generujemy na żądanie
+
+
+def match_score(concept, sheet):
+    """Dopasowanie karty do konceptu; None, gdy koncept wprost wskazuje inną klasę albo rasę."""
+    wanted_class, wanted_race = detect(concept, CLASS_PATTERNS), detect(concept, RACE_PATTERNS)
+    if wanted_class and wanted_class != sheet.get("klasa"): return None
+    if wanted_race and wanted_race != detect(sheet.get("rasa"), RACE_PATTERNS): return None
+    story = set(tokenize(sheet.get("historia")))
+    return 2 * bool(wanted_class) + 2 * bool(wanted_race) + sum(1 for word in set(tokenize(concept)) if len(word) > 3 and word in story)
+
+
+def pool_counts(db, classes):
+    pool = db.collection(POOL_COLLECTION)
+    return {klasa: pool.where(filter=firestore.FieldFilter("klasa", "==", klasa)).count().get()[0][0].value for klasa in classes}
+
+
+def add_to_pool(db, sheet):
+    db.collection(POOL_COLLECTION).document().set({**sheet, "pooled_at": firestore.SERVER_TIMESTAMP})
+
+
+def claim_character(db, concept, characters_ref):
+    """Przenosi najlepiej pasującą kartę z puli do `characters_ref`; zwraca jej dane albo None (brak pasującej).
+
+    Karta musi mieć klasę wskazaną w koncepcie albo uzyskać co najmniej MIN_MATCH_SCORE - koncept, którego
+    nie rozpoznajemy ("nekromanta"), nie dostaje przypadkowej karty, tylko idzie do generowania przez GPT.
+    """
+    pool = db.collection(POOL_COLLECTION)
+    wanted_class = detect(concept, CLASS_PATTERNS)
+    if wanted_class: pool = pool.where(filter=firestore.FieldFilter("klasa", "==", wanted_class))
+    scored = [(match_score(concept, doc.to_dict()), doc) for doc in pool.limit(MATCH_CANDIDATES).stream()]
+    min_score = 0 if wanted_class else MIN_MATCH_SCORE
+    ranked = [doc for score, doc in sorted((s for s in scored if s[0] is not None and s[0] >= min_score), key=lambda s: -s[0])]
+    for doc in ranked[:CLAIM_ATTEMPTS]:
+        sheet = _claim(db, doc.reference, characters_ref)
+        if sheet: return sheet
+    return None
+
+
+def _claim(db, pool_doc_ref, characters_ref):
+    @firestore.transactional
+    def claim(transaction):
+        snapshot = pool_doc_ref.get(transaction=transaction)
+        if not snapshot.exists: return None  # przejęła ją inna sesja
+        sheet = {key: value for key, value in snapshot.to_dict().items() if key != "pooled_at"}
+        target = characters_ref.document(sheet["imię"])
+        if target.get(transaction=transaction).exists: return None  # gracz ma już postać o tym imieniu
+        transaction.set(target, {**sheet, "xp": 0, "level": 1})
+        transaction.delete(pool_doc_ref)
+        return sheet
+    return claim(db.transaction())
+
+
+class CharacterPoolProducer:
+    """Wątek w tle utrzymujący w puli po `target` kart każdej klasy; `wake()` przyspiesza dopełnienie po przejęciu."""
+    def __init__(self, db, classes, target, make_character, interval):
+        self.db, self.classes, self.target = db, classes, target
+        self.make_character, self.interval = make_character, interval
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="character-pool", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def refill(self):
+        """Jedno dopełnienie puli; zwraca liczbę dodanych kart. Klasy z największym brakiem idą pierwsze."""
+        counts, added = pool_counts(self.db, self.classes), 0
+        for klasa in sorted(self.classes, key=lambda k: counts[k]):
+            for _ in range(self.target - counts[klasa]):
+                sheet = self.make_character(klasa)
+                # Karta innej klasy niż zamówiona też się przyda, o ile tamta klasa ma jeszcze wolne miejsce.
+                if not is_complete(sheet) or not sheet.get("portrait_url") or counts.get(sheet["klasa"], self.target) >= self.target: continue
+                add_to_pool(self.db, sheet)
+                counts[sheet["klasa"]] += 1
+                added += 1
+        return added
+
+    def _run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                pass  # chwilowy błąd API lub Firestore - spróbujemy przy następnym obiegu
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,57 @@
+"""Leniwe SDK i klienci: import rdzenia gry nie wczytuje google-cloud-firestore, openai ani httpx.
+
+`firestore`, `service_account`, `openai` i `httpx` to pośrednicy modułów - SDK wczytuje się przy pierwszym
+dostępie do atrybutu (np. firestore.SERVER_TIMESTAMP). LazyClient tak samo odkłada utworzenie klienta
+(połączenie z Firestore, pula OpenAI) do pierwszego wywołania metody, więc ekran logowania ich nie dotyka.
+"""
+import importlib
+import threading
+
+from .instrumentation import InstrumentedClient, InstrumentedOpenAI
+from .openai_pool import OpenAIPool
+
+
+class LazyModule:
+    """Moduł importowany przy pierwszym dostępie do atrybutu (atrapy z sys.modules też działają)."""
+    def __init__(self, name):
+        self._name, self._module = name, None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class LazyClient:
+    """Klient tworzony przez `factory()` przy pierwszym użyciu, np. db.collection(...)."""
+    def __init__(self, factory):
+        self._factory, self._client = factory, None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None: self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+firestore = LazyModule("google.cloud.firestore")
+service_account = LazyModule("google.oauth2.service_account")
+openai = LazyModule("openai")
+httpx = LazyModule("httpx")
+
+
+def connect_firestore(credentials_info, metrics):
+    """Klient Firestore z konta serwisowego (słownik jak w secrets), z pomiarem operacji."""
+    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    return InstrumentedClient(firestore.Client(credentials=credentials, project=credentials_info["project_id"]), metrics)
+
+
+def connect_openai(api_key, metrics, chat_lane, image_lane, max_connections, timeout, max_retries):
+    """Jeden klient OpenAI na proces: pula połączeń keep-alive, osobne pasy czatu i obrazów, ponawianie po stronie puli."""
+    http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                               timeout=httpx.Timeout(timeout, connect=10))
+    client = openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    return OpenAIPool(InstrumentedOpenAI(client, metrics), chat_lane, image_lane, max_retries=max_retries)
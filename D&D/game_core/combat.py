@@ -0,0 +1,190 @@
+"""Lokalny silnik walki: inicjatywa, rzuty kośćmi (k20/k6...), trafienia, obrażenia, PŻ i automatyczne tury potworów.
+
+Moduł nie zależy od Streamlit ani Firestore. Stan walki to zwarty słownik zapisywany w dokumencie gry
+(`combat`): numer rundy i lista uczestników w kolejności inicjatywy. Jedna runda to jeden zapis.
+Model językowy tylko opisuje przebieg rundy na podstawie dziennika - nie decyduje o wynikach.
+Rzuty pochodzą z generatora z ziarnem zapisanym w stanie walki i numerem rundy, więc ponowne rozegranie
+tej samej rundy (np. po nieudanym zapisie) daje identyczny wynik.
+"""
+import random
+import re
+from dataclasses import dataclass, field
+
+from .sheets import hit_points
+
+DICE_PATTERN = re.compile(r'^\s*(\d*)\s*k\s*(\d+)\s*(?:([+-])\s*(\d+))?\s*$', re.IGNORECASE)
+
+# Statystyki bojowe klas: klasa pancerza, premia do ataku, kość obrażeń, premia do inicjatywy.
+CLASS_COMBAT = {
+    "Wojownik": {"ac": 16, "atk": 5, "dmg": "k10+3", "init": 1},
+    "Łotrzyk": {"ac": 14, "atk": 5, "dmg": "k6+3", "init": 3},
+    "Mag": {"ac": 12, "atk": 5, "dmg": "k10", "init": 2},
+    "Kleryk": {"ac": 15, "atk": 4, "dmg": "k8+2", "init": 0},
+}
+DEFAULT_CLASS_COMBAT = {"ac": 13, "atk": 4, "dmg": "k8+1", "init": 1}
+
+# Potwory rozpoznajemy po fragmencie nazwy z tagu [WALKA: START;...]; PŻ losujemy przy starcie walki.
+MONSTERS = {
+    "goblin": {"hp": "2k6", "ac": 13, "atk": 4, "dmg": "k6+2", "init": 2, "xp": 50},
+    "kobold": {"hp": "2k6-2", "ac": 12, "atk": 4, "dmg": "k4+2", "init": 2, "xp": 25},
+    "wilk": {"hp": "2k8+2", "ac": 13, "atk": 4, "dmg": "2k4+2", "init": 2, "xp": 50},
+    "bandyta": {"hp": "2k8+2", "ac": 12, "atk": 3, "dmg": "k6+1", "init": 1, "xp": 25},
+    "szkielet": {"hp": "2k8+4", "ac": 13, "atk": 4, "dmg": "k6+2", "init": 2, "xp": 50},
+    "zombi": {"hp": "3k8+9", "ac": 8, "atk": 3, "dmg": "k6+1", "init": -2, "xp": 50},
+    "ork": {"hp": "2k8+6", "ac": 13, "atk": 5, "dmg": "k12+3", "init": 1, "xp": 100},
+    "ogr": {"hp": "7k10+21", "ac": 11, "atk": 6, "dmg": "2k8+4", "init": -1, "xp": 450},
+    "troll": {"hp": "8k10+40", "ac": 15, "atk": 7, "dmg": "2k6+4", "init": 1, "xp": 1800},
+    "smok": {"hp": "10k10+30", "ac": 17, "atk": 7, "dmg": "2k10+4", "init": 0, "xp": 2300},
+}
+DEFAULT_MONSTER = {"hp": "3k8+3", "ac": 13, "atk": 4, "dmg": "k8+2", "init": 1, "xp": 100}
+
+HEAL_DICE = "2k4+2"  # mikstura leczenia / czar leczący
+HEAL_WORDS = ("mikstur", "lecz")
+FLEE_WORDS = ("uciek", "wycof")
+DEFEND_AC_BONUS = 2  # gracz bez akcji w rundzie broni się: +2 do KP
+
+
+def roll(expression, rng=random):
+    """Rzut w notacji kości z aplikacji: "k20", "2k6+3", "k8-1"."""
+    match = DICE_PATTERN.match(expression)
+    if not match: raise ValueError(f"Nieprawidłowy zapis kości: {expression}")
+    count, sides = int(match.group(1) or 1), int(match.group(2))
+    bonus = int(match.group(4) or 0) * (-1 if match.group(3) == "-" else 1)
+    return sum(rng.randint(1, sides) for _ in range(count)) + bonus
+
+
+def _crit(expression):
+    """Trafienie krytyczne: podwójna liczba kości, premia bez zmian."""
+    match = DICE_PATTERN.match(expression)
+    return f"{2 * int(match.group(1) or 1)}k{match.group(2)}{match.group(3) or ''}{match.group(4) or ''}"
+
+
+def _as_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def player_combatant(member, rng):
+    stats = CLASS_COMBAT.get(member.get("klasa"), DEFAULT_CLASS_COMBAT)
+    level = _as_int(member.get("level"), 1)
+    hp = max(hit_points(member.get("current_hp")), 0)
+    max_hp = max(hit_points(member.get("max_hp")), hp, 1)  # ranny gracz może się leczyć do PŻ z karty
+    return {"name": member["name"], "side": "player", "hp": hp, "max_hp": max_hp, "ac": stats["ac"],
+            "atk": stats["atk"] + (level - 1) // 2, "dmg": stats["dmg"], "init": roll("k20", rng) + stats["init"]}
+
+
+def monster_combatant(name, rng):
+    stats = next((template for key, template in MONSTERS.items() if key in name.lower()), DEFAULT_MONSTER)
+    hp = max(roll(stats["hp"], rng), 1)
+    return {"name": name, "side": "monster", "hp": hp, "max_hp": hp, "ac": stats["ac"], "atk": stats["atk"],
+            "dmg": stats["dmg"], "init": roll("k20", rng) + stats["init"], "xp": stats["xp"]}
+
+
+def round_rng(state):
+    return random.Random(f"{state['seed']}:{state['round']}")
+
+
+def start_combat(party, monster_names, seed):
+    """Nowy stan walki: drużyna i potwory w kolejności inicjatywy (remisy rozstrzyga nazwa)."""
+    rng = random.Random(f"{seed}:0")
+    names, monsters = [], []
+    for raw_name in monster_names:
+        base = raw_name.strip()
+        if not base: continue
+        name, n = base, 2
+        while name in names: name, n = f"{base} {n}", n + 1  # dwa gobliny = "Goblin" i "Goblin 2"
+        names.append(name)
+        monsters.append(monster_combatant(name, rng))
+    order = [player_combatant(member, rng) for member in party] + monsters
+    order.sort(key=lambda c: (-c["init"], c["name"]))
+    return {"seed": seed, "round": 1, "order": order}
+
+
+@dataclass
+class RoundResult:
+    """Wynik jednej rundy: nowy stan (None = walka skończona), dziennik, PŻ graczy i nagrody."""
+    state: dict | None
+    round: int = 0  # numer rozegranej rundy - zapis sprawdza, że stan walki w grze wciąż na nią czeka
+    log: list = field(default_factory=list)
+    player_hp: dict = field(default_factory=dict)
+    outcome: str | None = None  # "zwycięstwo" / "porażka" / "ucieczka"
+    xp_awards: list = field(default_factory=list)
+
+
+def _living(order, side):
+    return [c for c in order if c["side"] == side and c["hp"] > 0]
+
+
+def _pick_target(content, monsters):
+    text = content.lower()
+    named = [m for m in monsters if m["name"].lower() in text]
+    return max(named, key=lambda m: len(m["name"])) if named else min(monsters, key=lambda m: (m["hp"], m["name"]))
+
+
+def _attack(attacker, target, rng, log, ac_bonus=0):
+    die = rng.randint(1, 20)
+    ac = target["ac"] + ac_bonus
+    if die == 1 or (die != 20 and die + attacker["atk"] < ac):
+        log.append(f"{attacker['name']} atakuje {target['name']} i pudłuje (k20: {die}+{attacker['atk']} vs KP {ac}).")
+        return
+    damage = max(roll(_crit(attacker["dmg"]) if die == 20 else attacker["dmg"], rng), 1)
+    target["hp"] = max(target["hp"] - damage, 0)
+    hit = "krytycznie trafia" if die == 20 else "trafia"
+    status = "pada!" if target["hp"] == 0 else f"{target['hp']}/{target['max_hp']} PŻ"
+    log.append(f"{attacker['name']} {hit} {target['name']} (k20: {die}+{attacker['atk']} vs KP {ac}) za {damage} obrażeń - {status}")
+
+
+def resolve_round(state, actions, rng=None):
+    """Rozgrywa jedną rundę w kolejności inicjatywy.
+
+    Gracze z akcją w tej rundzie atakują wskazanego (albo najsłabszego) potwora, leczą się lub uciekają;
+    gracze bez akcji bronią się. Potwory atakują losowego przytomnego gracza.
+    """
+    rng = rng or round_rng(state)
+    order = [dict(c) for c in state["order"]]
+    actions_by_player = {}
+    for action in actions:
+        actions_by_player.setdefault(action.get("player_name"), []).append(action.get("content", ""))
+    log, fled, defending = [f"**Runda {state['round']}**"], set(), set()
+    for combatant in order:
+        if combatant["hp"] <= 0: continue
+        monsters, players = _living(order, "monster"), [p for p in _living(order, "player") if p["name"] not in fled]
+        if not monsters or not players: break
+        if combatant["side"] == "monster":
+            target = rng.choice(players)
+            _attack(combatant, target, rng, log, DEFEND_AC_BONUS if target["name"] in defending else 0)
+            continue
+        content = " ".join(actions_by_player.get(combatant["name"], [])).lower()
+        if not content:
+            defending.add(combatant["name"])
+            log.append(f"{combatant['name']} przyjmuje postawę obronną (+{DEFEND_AC_BONUS} KP).")
+        elif any(word in content for word in FLEE_WORDS):
+            fled.add(combatant["name"])
+            log.append(f"{combatant['name']} wycofuje się z walki.")
+        elif any(word in content for word in HEAL_WORDS) and combatant["hp"] < combatant["max_hp"]:
+            healed = min(roll(HEAL_DICE, rng), combatant["max_hp"] - combatant["hp"])
+            combatant["hp"] += healed
+            log.append(f"{combatant['name']} leczy się o {healed} PŻ ({combatant['hp']}/{combatant['max_hp']}).")
+        else:
+            _attack(combatant, _pick_target(content, monsters), rng, log)
+
+    result = RoundResult(state={**state, "round": state["round"] + 1, "order": order}, round=state["round"], log=log,
+                         player_hp={c["name"]: c["hp"] for c in order if c["side"] == "player"})
+    monsters, players = _living(order, "monster"), _living(order, "player")
+    if not monsters:
+        result.state, result.outcome = None, "zwycięstwo"
+        xp_total, winners = sum(c.get("xp", 0) for c in order if c["side"] == "monster"), [p["name"] for p in players]
+        result.xp_awards = [{"player": name, "amount": xp_total // len(winners)} for name in winners] if winners and xp_total else []
+    elif not players:
+        result.state, result.outcome = None, "porażka"
+    elif all(p["name"] in fled for p in players):
+        result.state, result.outcome = None, "ucieczka"
+    return result
+
+
+def describe_combat(state):
+    """Jedna linia na uczestnika w kolejności inicjatywy - do promptu MG i panelu walki."""
+    return [f"{c['name']} ({'gracz' if c['side'] == 'player' else 'wróg'}): {c['hp']}/{c['max_hp']} PŻ, KP {c['ac']}, inicjatywa {c['init']}"
+            for c in state.get("order", [])]
@@ -0,0 +1,127 @@
+"""Parser tagów z odpowiedzi Mistrza Gry (`[IMG: ...]`, `[NPC: ...]`, `[WALKA: ...]` itd.).
+
+Moduł nie zależy od Streamlit ani Firestore - korzystają z niego aplikacja, strumieniowanie tury i benchmarki.
+"""
+import re
+from dataclasses import dataclass, field
+
+TAG_NAMES = ("IMG", "TLO", "MAPA", "ZADANIE", "WYBÓR", "LOOT", "XP", "NPC_REMOVE", "NPC", "WALKA")
+# Jedna alternatywa dla wszystkich tagów: tekst odpowiedzi skanujemy dokładnie raz.
+TAG_PATTERN = re.compile(r'\[(' + "|".join(TAG_NAMES) + r'):\s*([^\]]*)\]', re.IGNORECASE)
+MAX_TAG_LENGTH = 2000  # dłuższy "tag" bez zamknięcia traktujemy podczas strumieniowania jako zwykły tekst
+
+
+@dataclass
+class DMReply:
+    """Odpowiedź MG rozłożona na narrację i efekty gry."""
+    narrative: str = ""
+    img_prompt: str | None = None
+    bg_keyword: str | None = None
+    map_prompt: str | None = None
+    quest_update: str | None = None
+    loot_items: list = field(default_factory=list)
+    xp_awards: list = field(default_factory=list)
+    choices: list = field(default_factory=list)
+    npcs: list = field(default_factory=list)
+    removed_npcs: list = field(default_factory=list)
+    combat_updates: list = field(default_factory=list)
+
+
+def _apply_tag(reply, name, body):
+    """Wpisuje treść tagu do `reply`. Zwraca False dla tagu w złym formacie - taki zostaje w narracji."""
+    if name == "IMG":
+        if reply.img_prompt is None: reply.img_prompt = body.strip()
+    elif name == "TLO":
+        if reply.bg_keyword is None: reply.bg_keyword = body.strip().lower()
+    elif name == "MAPA":
+        if reply.map_prompt is None: reply.map_prompt = body.strip()
+    elif name == "ZADANIE":
+        if reply.quest_update is None: reply.quest_update = body.strip()
+    elif name == "WYBÓR":
+        if not reply.choices: reply.choices = [c.strip().strip('"') for c in body.split(';')]
+    elif name == "LOOT":
+        parts = body.split(';', 2)
+        if len(parts) < 3: return False
+        reply.loot_items.append({"player": parts[0].strip(), "item": parts[1].strip(), "desc": parts[2].strip()})
+    elif name == "XP":
+        player, _, amount = body.rpartition(';')
+        if not player or not amount.strip().isdigit(): return False
+        reply.xp_awards.append({"player": player.strip(), "amount": int(amount)})
+    elif name == "NPC":
+        parts = body.split(';', 2)
+        if len(parts) < 3: return False
+        reply.npcs.append({"name": parts[0].strip(), "desc": parts[1].strip(), "portrait_prompt": parts[2].strip()})
+    elif name == "NPC_REMOVE":
+        reply.removed_npcs.append(body.strip())
+    elif name == "WALKA":
+        reply.combat_updates.append(body.strip())
+    return True
+
+
+def parse_response_from_dm(text):
+    """Jednoprzebiegowo wyciąga tagi z odpowiedzi MG i składa narrację z fragmentów między nimi."""
+    reply = DMReply()
+    pieces, last_end = [], 0
+    for match in TAG_PATTERN.finditer(text):
+        if _apply_tag(reply, match.group(1).upper(), match.group(2)):
+            pieces.append(text[last_end:match.start()])
+            last_end = match.end()
+    pieces.append(text[last_end:])
+    reply.narrative = "".join(pieces).strip()
+    return reply
+
+
+def is_valid_tag(tag_text):
+    """Czy pełny tekst `[NAZWA: ...]` jest tagiem w poprawnym formacie (ten sam test co w parse_response_from_dm)."""
+    match = TAG_PATTERN.fullmatch(tag_text)
+    return bool(match) and _apply_tag(DMReply(), match.group(1).upper(), match.group(2))
+
+
+def tag_name(tag_text):
+    """Nazwa tagu (wielkimi literami) z pełnego tekstu `[NAZWA: ...]`."""
+    return tag_text[1:].split(":", 1)[0].strip().upper()
+
+
+class StreamingTagParser:
+    """Przyrostowo oddziela tagi MG od narracji podczas strumieniowania odpowiedzi.
+
+    feed() dopisuje widoczny tekst do `visible` i zwraca tagi (pełny tekst tagu), które właśnie się domknęły.
+    Tag w złym formacie zostaje w `visible` - tak jak w narracji z parse_response_from_dm.
+    """
+    def __init__(self):
+        self._visible_parts = []
+        self._pending = ""
+
+    @property
+    def visible(self):
+        if len(self._visible_parts) > 1: self._visible_parts = ["".join(self._visible_parts)]
+        return self._visible_parts[0] if self._visible_parts else ""
+
+    def _could_be_tag(self, text):
+        head, colon, _ = text[1:].partition(":")
+        head = head.upper()
+        if colon: return head in TAG_NAMES
+        return any(name.startswith(head) for name in TAG_NAMES)
+
+    def feed(self, chunk):
+        self._pending += chunk
+        closed_tags = []
+        while self._pending:
+            start = self._pending.find("[")
+            if start == -1:
+                self._visible_parts.append(self._pending); self._pending = ""; break
+            self._visible_parts.append(self._pending[:start])
+            self._pending = self._pending[start:]
+            end = self._pending.find("]")
+            if end == -1:
+                if len(self._pending) > MAX_TAG_LENGTH or not self._could_be_tag(self._pending):
+                    self._visible_parts.append("["); self._pending = self._pending[1:]; continue
+                break
+            candidate, self._pending = self._pending[:end + 1], self._pending[end + 1:]
+            if is_valid_tag(candidate): closed_tags.append(candidate)
+            else: self._visible_parts.append(candidate)
+        return closed_tags
+
+    def close(self):
+        self._visible_parts.append(self._pending); self._pending = ""
+        return self.visible
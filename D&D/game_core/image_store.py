@@ -0,0 +1,138 @@
+"""Trwały magazyn obrazów adresowany treścią: klucz to skrót (prompt, rozmiar, model).
+
+Ten sam prompt w dowolnej grze i po restarcie serwera nie kosztuje ponownego wywołania DALL-E.
+W Firestore zapisujemy stabilne odwołanie `imgstore://<klucz>` zamiast wygasających URL-i OpenAI.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+STORE_URI_PREFIX = "imgstore://"
+
+
+def image_key(prompt, size, model):
+    return hashlib.sha256(f"{model}\0{size}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class LocalDirectoryBackend:
+    """Backend na lokalnym katalogu: plik `<klucz>.png`, a czas modyfikacji pliku służy jako czas ostatniego użycia (LRU).
+
+    Inny backend (np. magazyn obiektów) musi udostępniać te same metody; public_url() może wtedy zwracać stały adres.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.png")
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def read(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def write(self, key, data):
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+    def touch(self, key):
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """Lista (klucz, rozmiar w bajtach, czas ostatniego użycia)."""
+        result = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                result.append((entry.name[:-4], stat.st_size, stat.st_mtime))
+        return result
+
+    def public_url(self, key):
+        return None  # lokalne pliki podajemy do st.image jako bajty
+
+
+class ImageStore:
+    """Magazyn obrazów z generowaniem na żądanie, pojedynczym wywołaniem na klucz i usuwaniem najdawniej używanych (LRU).
+
+    Odczytane bajty trzyma też w pamięci procesu, ale najwyżej `memory_max_bytes` (obraz DALL-E to 1,5-3 MB);
+    brakujących obrazów nie zapamiętuje - mogą wrócić po ponownym wygenerowaniu.
+    """
+    def __init__(self, backend, max_bytes, memory_max_bytes=0):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._memory, self._memory_bytes = OrderedDict(), 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_or_generate(self, prompt, size, model, generate):
+        """Zwraca odwołanie `imgstore://<klucz>`; `generate()` (zwracające bajty obrazu) woła tylko dla nowych promptów."""
+        key = image_key(prompt, size, model)
+        with self._key_lock(key):  # dwie tury z tym samym promptem naraz = jedno wywołanie API
+            if self.backend.exists(key):
+                self.backend.touch(key)
+            else:
+                self.backend.write(key, generate())
+                self.evict()
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return f"{STORE_URI_PREFIX}{key}"
+
+    def resolve(self, ref):
+        """Stały URL z backendu albo bajty obrazu dla st.image; None, gdy obraz został już usunięty."""
+        key = ref[len(STORE_URI_PREFIX):]
+        url = self.backend.public_url(key)
+        if url: return url
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None: self._memory.move_to_end(key)
+        if data is None:
+            try:
+                data = self.backend.read(key)
+            except FileNotFoundError:
+                return None
+            self._remember(key, data)
+        self.backend.touch(key)
+        return data
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_max_bytes: return
+        with self._lock:
+            if key in self._memory: return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def evict(self):
+        entries = sorted(self.backend.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes: break
+            self.backend.delete(key)
+            total -= size
+        return total
+
+
+def is_store_ref(ref):
+    return isinstance(ref, str) and ref.startswith(STORE_URI_PREFIX)
+
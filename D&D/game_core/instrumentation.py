@@ -0,0 +1,373 @@
+"""Instrumentacja gorących ścieżek: liczniki operacji Firestore oraz czasy wywołań OpenAI i odcinków tury.
+
+Klienta Firestore i moduł `openai` owijamy cienkimi pośrednikami. Zliczają one odczyty, zapisy i usunięcia
+per kolekcja, a także mierzą czasy. Każdy pomiar przypisujemy do gry (ze ścieżki dokumentu albo z kontekstu),
+a zakresy (przebieg skryptu, fragment, tura MG) także do sesji - contextvars ustawiane na początku przebiegu.
+Liczniki procesu nie mają wymiaru sesji, więc nie rosną z liczbą odwiedzin. Dzięki temu widać, które kampanie
+kosztują najwięcej. Eksport: JSONL (jedna linia na przebieg skryptu lub turę MG) oraz tekst w formacie Prometheusa.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import types
+from collections import Counter
+
+current_game = contextvars.ContextVar("current_game", default=None)
+current_session = contextvars.ContextVar("current_session", default=None)
+_current_scope = contextvars.ContextVar("current_scope", default=None)
+
+
+def game_from_path(path):
+    parts = path.split("/")
+    return parts[1] if len(parts) > 1 and parts[0] == "games" else None
+
+
+def active_scope():
+    """Zakres, do którego trafiają pomiary w tym kontekście; None poza przebiegiem skryptu i turą."""
+    return _current_scope.get()
+
+
+def in_current_context(fn):
+    """Owija fn tak, by w wątku puli działała z kontekstem (gra, sesja, zakres) wątku wywołującego."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)  # kopia: pool.map woła równolegle
+
+
+class _Timing:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self): self.count, self.total, self.max = 0, 0.0, 0.0
+
+    def add(self, seconds):
+        self.count += 1; self.total += seconds; self.max = max(self.max, seconds)
+
+    def to_dict(self): return {"count": self.count, "total_s": round(self.total, 6), "max_s": round(self.max, 6)}
+
+
+class Scope:
+    """Pomiary jednego przebiegu skryptu albo jednej tury MG: operacje per kolekcja i czasy odcinków."""
+    def __init__(self, kind):
+        self.kind, self.game, self.session = kind, current_game.get(), current_session.get()
+        self.started, self.seconds = time.time(), None
+        self.ops, self.spans = Counter(), {}
+        self._lock = threading.Lock()
+
+    def add_op(self, op, collection, n):
+        with self._lock: self.ops[(op, collection)] += n
+
+    def add_span(self, name, seconds):
+        with self._lock: self.spans.setdefault(name, _Timing()).add(seconds)
+
+    def totals(self):
+        with self._lock:
+            result = Counter()
+            for (op, _), n in self.ops.items(): result[op] += n
+            return dict(result)
+
+    def to_record(self):
+        with self._lock:
+            return {
+                "ts": round(self.started, 3), "kind": self.kind, "game": self.game, "session": self.session,
+                "seconds": round(self.seconds, 6) if self.seconds is not None else None,
+                "ops": {f"{op}:{collection}": n for (op, collection), n in sorted(self.ops.items())},
+                "spans": {name: timing.to_dict() for name, timing in sorted(self.spans.items())},
+            }
+
+
+class Metrics:
+    """Liczniki procesu: operacje Firestore (op, kolekcja, gra), odcinki (nazwa, gra), wywołania OpenAI (rodzaj, model)."""
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.jsonl_path, self.prometheus_path = jsonl_path, prometheus_path
+        self.ops, self.spans, self.openai = Counter(), {}, {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+    # --- Rejestrowanie ---
+    def record_op(self, op, collection, n=1, game=None):
+        if n <= 0: return
+        game = game or current_game.get()
+        with self._lock: self.ops[(op, collection, game)] += n
+        scope = _current_scope.get()
+        if scope: scope.add_op(op, collection, n)
+
+    def record_span(self, name, seconds):
+        with self._lock: self.spans.setdefault((name, current_game.get()), _Timing()).add(seconds)
+        scope = _current_scope.get()
+        if scope: scope.add_span(name, seconds)
+
+    def record_openai(self, kind, model, seconds):
+        with self._lock: self.openai.setdefault((kind, model), _Timing()).add(seconds)
+        self.record_span(f"openai.{kind}", seconds)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def scope(self, kind):
+        """Zbiera wszystko, co wydarzy się w bloku (także w wątkach z in_current_context), i zapisuje linię JSONL."""
+        scope = Scope(kind)
+        token = _current_scope.set(scope)
+        started = time.perf_counter()
+        try:
+            yield scope
+        finally:
+            scope.seconds = time.perf_counter() - started
+            _current_scope.reset(token)
+            self.export(scope)
+
+    # --- Raporty ---
+    def cost_by_game(self, limit=10):
+        """Najdroższe gry: (gra, odczyty, zapisy, usunięcia) malejąco po sumie operacji."""
+        with self._lock: items = list(self.ops.items())
+        per_game = {}
+        for (op, _, game), n in items:
+            if game: per_game.setdefault(game, Counter())[op] += n
+        ranked = sorted(per_game.items(), key=lambda item: -sum(item[1].values()))
+        return [(game, c["read"], c["write"], c["delete"]) for game, c in ranked[:limit]]
+
+    def prometheus_text(self):
+        with self._lock:
+            ops, spans, calls = Counter(self.ops), dict(self.spans), dict(self.openai)
+        lines = ["# HELP dd_firestore_ops_total Operacje Firestore per kolekcja i gra.", "# TYPE dd_firestore_ops_total counter"]
+        lines += [f'dd_firestore_ops_total{{op="{op}",collection="{_label(collection)}",game="{_label(game)}"}} {n}' for (op, collection, game), n in sorted(ops.items(), key=str)]
+        for metric, series, labels in (("dd_span_seconds", spans, ("span", "game")), ("dd_openai_seconds", calls, ("kind", "model"))):
+            lines += [f"# TYPE {metric} summary"]
+            for key, timing in sorted(series.items(), key=str):
+                label_text = ",".join(f'{name}="{_label(value)}"' for name, value in zip(labels, key))
+                lines += [f"{metric}_count{{{label_text}}} {timing.count}", f"{metric}_sum{{{label_text}}} {timing.total:.6f}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self, scope):
+        """Dopisuje linię JSONL i nadpisuje plik Prometheusa (kolektor textfile), jeśli ścieżki są skonfigurowane."""
+        if not (self.jsonl_path or self.prometheus_path): return
+        with self._file_lock:
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(scope.to_record(), ensure_ascii=False) + "\n")
+            if self.prometheus_path:
+                tmp_path = f"{self.prometheus_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f: f.write(self.prometheus_text())
+                os.replace(tmp_path, self.prometheus_path)
+
+
+def _label(value):
+    return str(value if value is not None else "").replace("\\", "\\\\").replace('"', '\\"')
+
+
+# --- Firestore: pośrednicy liczący operacje ---
+def _unwrap(obj):
+    return obj._wrapped if isinstance(obj, _Proxy) else obj
+
+
+class _Proxy:
+    """Przepuszcza wszystko do obiektu Firestore; nadpisuje tylko metody, które wykonują operacje."""
+    def __init__(self, wrapped, metrics):
+        self._wrapped, self._metrics = wrapped, metrics
+
+    def __getattr__(self, name): return getattr(self._wrapped, name)
+    def __eq__(self, other): return self._wrapped == _unwrap(other)
+    def __hash__(self): return hash(self._wrapped)
+    def __repr__(self): return f"Instrumented({self._wrapped!r})"
+
+
+class _Listener:
+    """Firestore rozlicza nasłuch jako odczyt każdego zmienionego dokumentu w migawce."""
+    def __init__(self, metrics, collection, game, callback):
+        self.metrics, self.collection, self.game, self.callback = metrics, collection, game, callback
+
+    def __call__(self, docs, changes, read_time):
+        self.metrics.record_op("read", self.collection, max(len(changes), 1), game=self.game)
+        return self.callback(docs, changes, read_time)
+
+
+class InstrumentedDocument(_Proxy):
+    def __init__(self, wrapped, metrics):
+        super().__init__(wrapped, metrics)
+        self._collection_id, self._game = wrapped.path.split("/")[-2], game_from_path(wrapped.path)
+
+    def _record(self, op, n=1): self._metrics.record_op(op, self._collection_id, n, game=self._game)
+
+    def collection(self, name): return InstrumentedQuery(self._wrapped.collection(name), self._metrics, name, self._game)
+
+    def get(self, *args, **kwargs):
+        snapshot = self._wrapped.get(*args, **kwargs)
+        self._record("read")
+        return snapshot
+
+    def set(self, *args, **kwargs): self._record("write"); return self._wrapped.set(*args, **kwargs)
+    def update(self, *args, **kwargs): self._record("write"); return self._wrapped.update(*args, **kwargs)
+    def create(self, *args, **kwargs): self._record("write"); return self._wrapped.create(*args, **kwargs)
+    def delete(self, *args, **kwargs): self._record("delete"); return self._wrapped.delete(*args, **kwargs)
+
+    def on_snapshot(self, callback):
+        return self._wrapped.on_snapshot(_Listener(self._metrics, self._collection_id, self._game, callback))
+
+
+class InstrumentedQuery(_Proxy):
+    """Zapytanie albo kolekcja; metody budujące zapytanie zwracają kolejnego pośrednika z tą samą kolekcją i grą."""
+    CHAINED = frozenset({"where", "order_by", "limit", "limit_to_last", "offset", "select", "start_at", "start_after", "end_at", "end_before"})
+
+    def __init__(self, wrapped, metrics, collection_id, game):
+        super().__init__(wrapped, metrics)
+        self._collection_id, self._game = collection_id, game
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in self.CHAINED: return attr
+        return lambda *args, **kwargs: InstrumentedQuery(attr(*args, **kwargs), self._metrics, self._collection_id, self._game)
+
+    def document(self, *args, **kwargs): return InstrumentedDocument(self._wrapped.document(*args, **kwargs), self._metrics)
+
+    def add(self, *args, **kwargs):
+        self._metrics.record_op("write", self._collection_id, game=self._game)
+        return self._wrapped.add(*args, **kwargs)
+
+    def stream(self, *args, **kwargs):
+        count = 0
+        try:
+            for snapshot in self._wrapped.stream(*args, **kwargs):
+                count += 1
+                yield snapshot
+        finally:
+            self._metrics.record_op("read", self._collection_id, max(count, 1), game=self._game)  # puste zapytanie = 1 odczyt
+
+    def get(self, *args, **kwargs): return list(self.stream(*args, **kwargs))
+
+    def count(self, *args, **kwargs): return InstrumentedAggregation(self._wrapped.count(*args, **kwargs), self._metrics, self._collection_id, self._game)
+
+    def on_snapshot(self, callback):
+        return self._wrapped.on_snapshot(_Listener(self._metrics, self._collection_id, self._game, callback))
+
+
+class InstrumentedAggregation(_Proxy):
+    def __init__(self, wrapped, metrics, collection_id, game):
+        super().__init__(wrapped, metrics)
+        self._collection_id, self._game = collection_id, game
+
+    def get(self, *args, **kwargs):
+        result = self._wrapped.get(*args, **kwargs)
+        self._metrics.record_op("read", self._collection_id, game=self._game)  # 1 odczyt na 1000 pozycji indeksu
+        return result
+
+
+class InstrumentedBatch(_Proxy):
+    """Zapisy partii liczymy dopiero przy zatwierdzeniu - wtedy są rozliczane."""
+    def __init__(self, wrapped, metrics):
+        super().__init__(wrapped, metrics)
+        self._pending = []
+
+    def _queue(self, op, reference):
+        reference = _unwrap(reference)
+        self._pending.append((op, reference.path.split("/")[-2], game_from_path(reference.path)))
+        return reference
+
+    def set(self, reference, *args, **kwargs): return self._wrapped.set(self._queue("write", reference), *args, **kwargs)
+    def update(self, reference, *args, **kwargs): return self._wrapped.update(self._queue("write", reference), *args, **kwargs)
+    def create(self, reference, *args, **kwargs): return self._wrapped.create(self._queue("write", reference), *args, **kwargs)
+    def delete(self, reference, *args, **kwargs): return self._wrapped.delete(self._queue("delete", reference), *args, **kwargs)
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        for op, collection_id, game in pending: self._metrics.record_op(op, collection_id, game=game)
+
+    def commit(self, *args, **kwargs):
+        result = self._wrapped.commit(*args, **kwargs)
+        self._flush()
+        return result
+
+
+class InstrumentedTransaction(InstrumentedBatch):
+    """Działa z @firestore.transactional: dekorator woła _begin/_commit/_clean_up przez pośrednika."""
+    def get(self, ref_or_query, *args, **kwargs):
+        target = _unwrap(ref_or_query)
+        snapshots = list(self._wrapped.get(target, *args, **kwargs))
+        collection_id = ref_or_query._collection_id if isinstance(ref_or_query, _Proxy) else "?"
+        game = ref_or_query._game if isinstance(ref_or_query, _Proxy) else None
+        self._metrics.record_op("read", collection_id, max(len(snapshots), 1), game=game)
+        return iter(snapshots)
+
+    def get_all(self, references, *args, **kwargs):
+        snapshots = list(self._wrapped.get_all([_unwrap(ref) for ref in references], *args, **kwargs))
+        _record_snapshots(self._metrics, snapshots)
+        return iter(snapshots)
+
+    def _clean_up(self, *args, **kwargs):
+        self._pending = []  # ponowienie transakcji: poprzednie zapisy przepadły
+        return self._wrapped._clean_up(*args, **kwargs)
+
+    def _commit(self, *args, **kwargs):
+        result = self._wrapped._commit(*args, **kwargs)
+        self._flush()
+        return result
+
+
+def _record_snapshots(metrics, snapshots):
+    for snapshot in snapshots:
+        path = snapshot.reference.path
+        metrics.record_op("read", path.split("/")[-2], game=game_from_path(path))
+
+
+class InstrumentedClient(_Proxy):
+    def collection(self, name): return InstrumentedQuery(self._wrapped.collection(name), self._metrics, name, None)
+    def document(self, *args, **kwargs): return InstrumentedDocument(self._wrapped.document(*args, **kwargs), self._metrics)
+    def batch(self): return InstrumentedBatch(self._wrapped.batch(), self._metrics)
+    def transaction(self, **kwargs): return InstrumentedTransaction(self._wrapped.transaction(**kwargs), self._metrics)
+
+    def get_all(self, references, *args, **kwargs):
+        snapshots = list(self._wrapped.get_all([_unwrap(ref) for ref in references], *args, **kwargs))
+        _record_snapshots(self._metrics, snapshots)
+        return iter(snapshots)
+
+
+# --- OpenAI: pomiar czasu wywołań ---
+class _TimedStream:
+    """Strumień odpowiedzi: mierzymy czas do pierwszego fragmentu i do końca generacji."""
+    def __init__(self, stream, metrics, model, started):
+        self._stream, self._metrics, self._model, self._started = stream, metrics, model, started
+
+    def __iter__(self):
+        first = True
+        try:
+            for chunk in self._stream:
+                if first:
+                    self._metrics.record_openai("chat_first_token", self._model, time.perf_counter() - self._started)
+                    first = False
+                yield chunk
+        finally:
+            self._metrics.record_openai("chat_stream", self._model, time.perf_counter() - self._started)
+
+    def close(self):
+        """Zamyka połączenie HTTP strumienia SDK (przerwana iteracja, zwolnienie pasa w OpenAIPool)."""
+        getattr(self._stream, "close", lambda: None)()
+
+
+class InstrumentedOpenAI:
+    """Zamiennik `openai.chat.completions.create` i `openai.images.generate` z pomiarem czasu."""
+    def __init__(self, client, metrics):
+        self._client, self._metrics = client, metrics
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_completion))
+        self.images = types.SimpleNamespace(generate=self._generate_image)
+
+    def _create_completion(self, *args, **kwargs):
+        model, started = kwargs.get("model"), time.perf_counter()
+        if kwargs.get("stream"):
+            return _TimedStream(self._client.chat.completions.create(*args, **kwargs), self._metrics, model, started)
+        try:
+            return self._client.chat.completions.create(*args, **kwargs)
+        finally:
+            self._metrics.record_openai("chat", model, time.perf_counter() - started)
+
+    def _generate_image(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._client.images.generate(*args, **kwargs)
+        finally:
+            self._metrics.record_openai("images", kwargs.get("model"), time.perf_counter() - started)
@@ -0,0 +1,141 @@
+"""Wspólny dla procesu dostęp do OpenAI: limity tempa, ograniczona kolejka oczekujących i ponawianie błędów.
+
+Każdy rodzaj zapytań (czat, obrazy) ma własny pas: token bucket pilnuje tempa zapytań na minutę, limit
+równoległości - liczby otwartych połączeń, a kolejka oczekujących ma stały rozmiar. Gdy jest pełna, zapytanie
+od razu kończy się błędem OpenAIBusy zamiast wisieć bez końca. Błędy 429/5xx i zerwane połączenia ponawiamy
+z wykładniczym opóźnieniem z losowym rozrzutem (full jitter), z uwzględnieniem nagłówka Retry-After.
+Moduł nie importuje SDK - opakowuje dowolnego klienta z `chat.completions.create` i `images.generate`.
+"""
+import random
+import threading
+import time
+import types
+
+RETRY_STATUS = {408, 409, 429}  # plus wszystkie 5xx
+RETRY_ERRORS = {"APIConnectionError", "APITimeoutError"}
+
+
+class OpenAIBusy(RuntimeError):
+    """Kolejka zapytań do OpenAI jest pełna albo czas oczekiwania na miejsce minął."""
+
+
+class TokenBucket:
+    """Limit tempa: `rate_per_minute` żetonów na minutę, najwyżej `burst` naraz."""
+    def __init__(self, rate_per_minute, burst):
+        self.rate, self.capacity = rate_per_minute / 60.0, float(burst)
+        self._tokens, self._updated = float(burst), time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Pobiera żeton (także "na kredyt") i zwraca, ile sekund trzeba odczekać, zanim wolno go użyć."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class Lane:
+    """Pas jednego rodzaju zapytań: token bucket, limit równoległości i ograniczona kolejka oczekujących."""
+    def __init__(self, name, rate_per_minute, burst, max_concurrent, max_waiting, wait_timeout):
+        self.name, self.bucket = name, TokenBucket(rate_per_minute, burst)
+        self.max_concurrent, self.max_waiting, self.wait_timeout = max_concurrent, max_waiting, wait_timeout
+        self.active = self.waiting = 0
+        self._slots = threading.Condition()
+
+    def acquire(self):
+        with self._slots:
+            if self.active >= self.max_concurrent and self.waiting >= self.max_waiting:
+                raise OpenAIBusy(f"Kolejka zapytań ({self.name}) jest pełna: {self.waiting} oczekujących.")
+            self.waiting += 1
+            try:
+                if not self._slots.wait_for(lambda: self.active < self.max_concurrent, timeout=self.wait_timeout):
+                    raise OpenAIBusy(f"Zbyt długie oczekiwanie w kolejce zapytań ({self.name}).")
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        try:
+            time.sleep(self.bucket.reserve())
+        except BaseException:
+            self.release(); raise
+
+    def release(self):
+        with self._slots:
+            self.active -= 1
+            self._slots.notify()
+
+    def load(self):
+        with self._slots:
+            return {"active": self.active, "waiting": self.waiting}
+
+
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    return type(error).__name__ in RETRY_ERRORS or (status is not None and (status in RETRY_STATUS or status >= 500))
+
+
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class _LaneStream:
+    """Strumień czatu trzyma miejsce w pasie do ostatniego fragmentu (albo przerwania iteracji)."""
+    def __init__(self, stream, lane):
+        self._stream, self._lane, self._released = stream, lane, False
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        if self._released: return
+        self._released = True
+        getattr(self._stream, "close", lambda: None)()
+        self._lane.release()
+
+    def __del__(self):
+        self.close()
+
+
+class OpenAIPool:
+    """Zamiennik klienta OpenAI (`chat.completions.create`, `images.generate`) wspólny dla wszystkich sesji."""
+    def __init__(self, client, chat_lane, image_lane, max_retries=4, base_delay=0.5, max_delay=20.0):
+        self._client, self.lanes = client, {"chat": chat_lane, "images": image_lane}
+        self.max_retries, self.base_delay, self.max_delay = max_retries, base_delay, max_delay
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_completion))
+        self.images = types.SimpleNamespace(generate=self._generate_image)
+
+    def _create_completion(self, *args, **kwargs):
+        lane = self.lanes["chat"]
+        if not kwargs.get("stream"):
+            return self._call(lane, self._client.chat.completions.create, args, kwargs)
+        # Ponawiamy tylko otwarcie strumienia - po pierwszym fragmencie narracja jest już u graczy.
+        return _LaneStream(self._call(lane, self._client.chat.completions.create, args, kwargs, keep_slot=True), lane)
+
+    def _generate_image(self, *args, **kwargs):
+        return self._call(self.lanes["images"], self._client.images.generate, args, kwargs)
+
+    def _call(self, lane, fn, args, kwargs, keep_slot=False):
+        for attempt in range(self.max_retries + 1):
+            lane.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                lane.release()
+                if attempt == self.max_retries or not is_retryable(e): raise
+                delay = retry_after(e)
+                time.sleep(delay if delay is not None else random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                continue
+            if not keep_slot: lane.release()
+            return result
+
+    def load(self):
+        """Bieżące obciążenie pasów: {"chat": {"active": n, "waiting": m}, "images": {...}}."""
+        return {name: lane.load() for name, lane in self.lanes.items()}
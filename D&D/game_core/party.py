@@ -0,0 +1,92 @@
+"""Stan drużyny: zdenormalizowany dokument games/{id}/state/party z kartami, PŻ i ekwipunkiem członków."""
+from concurrent.futures import ThreadPoolExecutor
+
+from .clients import firestore
+from .instrumentation import in_current_context
+from .sheets import hit_points
+
+
+def character_ref(db, player_account, char_name):
+    return db.collection("players").document(player_account).collection("characters").document(char_name)
+
+
+def party_ref(game_ref):
+    return game_ref.collection("state").document("party")
+
+
+def party_member(player_account, sheet, current_hp, inventory):
+    """Wpis postaci w state/party: wszystko, czego potrzebują panel drużyny i prompt MG, bez czytania kart i ekwipunków."""
+    return {"account": player_account, "current_hp": current_hp, "max_hp": hit_points(sheet.get("punkty_życia")),
+            "level": sheet.get("level", 1), "xp": sheet.get("xp", 0), "klasa": sheet.get("klasa"), "portrait_url": sheet.get("portrait_url"), "inventory": inventory}
+
+
+def inventory_entry(item_id, item_data):
+    return {"id": item_id, "item_name": item_data.get("item_name", "Nieznany przedmiot"), "description": item_data.get("description", "")}
+
+
+def read_inventory(db, player_account, char_name):
+    return [inventory_entry(doc.id, doc.to_dict()) for doc in character_ref(db, player_account, char_name).collection("inventory").stream()]
+
+
+def rebuild_party_state(db, game_ref):
+    """Odbudowuje state/party z graczy, kart postaci i ekwipunków - dla gier sprzed denormalizacji."""
+    roster = [(doc.id, doc.to_dict()) for doc in game_ref.collection("players").stream()]
+    refs = [character_ref(db, data.get("player_account"), name) for name, data in roster]
+    sheets = {snap.reference.path: snap.to_dict() or {} for snap in db.get_all(refs)} if refs else {}
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(roster)))) as pool:
+        inventories = list(pool.map(in_current_context(lambda entry: read_inventory(db, entry[1].get("player_account"), entry[0])), roster))
+    members = {name: party_member(data.get("player_account"), sheets.get(ref.path, {}), data.get("current_hp", "0"), inventory)
+               for (name, data), ref, inventory in zip(roster, refs, inventories)}
+    party_ref(game_ref).set({"members": members}, merge=True)
+    return {"members": members}
+
+
+def join_party(db, game_ref, player_account, char_name):
+    """Dołącza postać do gry jedną transakcją; False, gdy karta nie istnieje.
+
+    Identyfikator gry trafia też na listę `games` karty - portret generowany w tle (set_character_portrait)
+    wie dzięki temu, w których state/party go uzupełnić. Obie transakcje czytają kartę, więc się nie miną.
+    """
+    char_doc_ref = character_ref(db, player_account, char_name)
+    inventory = read_inventory(db, player_account, char_name)
+
+    @firestore.transactional
+    def join(transaction):
+        snapshot = char_doc_ref.get(transaction=transaction)
+        if not snapshot.exists: return False
+        sheet = snapshot.to_dict()
+        current_hp = hit_points(sheet.get("punkty_życia"), 100)
+        transaction.set(game_ref.collection("players").document(char_name), {"current_hp": current_hp, "player_account": player_account, "joined_at": firestore.SERVER_TIMESTAMP})
+        transaction.set(party_ref(game_ref), {"members": {char_name: party_member(player_account, sheet, current_hp, inventory)}}, merge=True)
+        transaction.update(char_doc_ref, {"games": firestore.ArrayUnion([game_ref.id])})
+        return True
+    return join(db.transaction())
+
+
+def set_character_portrait(db, char_doc_ref, portrait_url):
+    """Zapisuje portret na karcie i we wpisie postaci w state/party każdej gry, w której nadal jest."""
+    @firestore.transactional
+    def store(transaction):
+        snapshot = char_doc_ref.get(transaction=transaction)
+        if not snapshot.exists: return
+        name = char_doc_ref.id
+        refs = [party_ref(db.collection("games").document(game_id)) for game_id in snapshot.to_dict().get("games", [])]
+        joined = [snap.reference for snap in transaction.get_all(refs) if snap.exists and name in (snap.to_dict() or {}).get("members", {})] if refs else []
+        transaction.update(char_doc_ref, {"portrait_url": portrait_url})
+        for ref in joined: transaction.set(ref, {"members": {name: {"portrait_url": portrait_url}}}, merge=True)
+    store(db.transaction())
+
+
+def update_player_hp(db, game_ref, char_name, new_hp):
+    batch = db.batch()
+    batch.update(game_ref.collection("players").document(char_name), {"current_hp": new_hp})
+    batch.set(party_ref(game_ref), {"members": {char_name: {"current_hp": new_hp}}}, merge=True)
+    batch.commit()
+
+
+def drop_item(db, game_ref, member, item):
+    """Usuwa przedmiot z ekwipunku postaci i z jej podsumowania w state/party jedną partią."""
+    batch = db.batch()
+    batch.delete(character_ref(db, member["account"], member["name"]).collection("inventory").document(item["id"]))
+    batch.set(party_ref(game_ref), {"members": {member["name"]: {"inventory": firestore.ArrayRemove([item])}}}, merge=True)
+    batch.commit()
@@ -0,0 +1,21 @@
+"""Zasady rozwoju postaci: progi PD, poziomy i umiejętności odblokowywane przez klasy."""
+
+XP_THRESHOLDS = {1: 0, 2: 300, 3: 900, 4: 2700, 5: 6500}
+CLASS_SKILLS = {
+    "Łotrzyk": {3: ["Atak z zaskoczenia"]}, "Mag": {3: ["Kula ognia"]},
+    "Wojownik": {3: ["Drugi oddech"]}, "Kleryk": {3: ["Leczenie ran"]}
+}
+
+
+def level_for_xp(xp, level=1):
+    """Poziom po zdobyciu PD: rośnie od `level`, dopóki osiągnięty jest próg następnego (poziomów się nie traci)."""
+    while level + 1 in XP_THRESHOLDS and xp >= XP_THRESHOLDS[level + 1]: level += 1
+    return level
+
+
+def xp_for_next_level(level, xp):
+    return XP_THRESHOLDS.get(level + 1, xp)  # na maksymalnym poziomie pasek postępu jest pełny
+
+
+def unlocked_skills(klasa, level):
+    return [skill for unlocked_at, skills in CLASS_SKILLS.get(klasa, {}).items() if level >= unlocked_at for skill in skills]
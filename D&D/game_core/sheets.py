@@ -0,0 +1,63 @@
+"""Karty postaci: parsowanie odpowiedzi GPT-4, kompletność i rozpoznawanie klasy oraz rasy."""
+import re
+
+REQUIRED_FIELDS = ("imię", "klasa", "rasa", "punkty_życia", "historia", "portrait_prompt")
+
+# Wzorce (bez rozróżniania wielkości liter) rozpoznające klasę i rasę w koncepcie gracza i w wygenerowanej karcie.
+CLASS_PATTERNS = {
+    "Łotrzyk": r"\b(łotr|złodziej|skryt|zabój|rogue|thief)",
+    "Mag": r"\b(mag(a|iem|ini|owie)?\b|czarodziej|czarnoksięż|wizard|sorcer)",
+    "Wojownik": r"\b(wojow|rycerz|barbarzyń|najemni|gladiator|fighter|warrior)",
+    "Kleryk": r"\b(kleryk|kapła|mnich|uzdrowi|cleric|priest)",
+}
+RACE_PATTERNS = {
+    "Elf": r"\belf",
+    "Krasnolud": r"\b(krasnolud|dwarf)",
+    "Niziołek": r"\b(niziołe|niziołk|halfling)",
+    "Gnom": r"\bgnom",
+    "Półork": r"\b(półork|ork(a|iem|owie|owy|owa|i)?\b|orc)",
+    "Tiefling": r"\b(tiefling|diabel)",
+    "Człowiek": r"\b(człowie|ludzk|human)",
+}
+
+
+def hit_points(value, default=0):
+    """PŻ jako liczba: GPT zapisuje je różnie ("24", "24 PŻ", "8 (1k6+2)") - liczy się pierwsza liczba całkowita."""
+    if isinstance(value, int): return value
+    match = re.match(r"\s*(\d+)", str(value or ""))
+    return int(match.group(1)) if match else default
+
+
+def tokenize(text):
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def detect(text, patterns):
+    """Kategoria (klasa/rasa) wspomniana w tekście najwcześniej; None, gdy żadna."""
+    found = [(match.start(), name) for name, pattern in patterns.items() if (match := re.search(pattern, text or "", re.IGNORECASE))]
+    return min(found)[1] if found else None
+
+
+def is_complete(sheet):
+    return bool(sheet) and all(sheet.get(key) for key in REQUIRED_FIELDS)
+
+
+def normalize_sheet(sheet):
+    """Klasa w kanonicznej postaci z CLASS_PATTERNS i PŻ jako liczba (umiejętności, walka i pula tego wymagają)."""
+    klasa, hp = detect(sheet.get("klasa"), CLASS_PATTERNS), hit_points(sheet.get("punkty_życia"))
+    return {**sheet, "klasa": klasa, "punkty_życia": hp} if klasa and hp > 0 else None
+
+
+def parse_character_sheet(sheet_text):
+    character = {}
+    try:
+        for line in sheet_text.strip().split('\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                character[key.strip().lower().replace(" ", "_")] = value.strip()
+        portrait_match = re.search(r'\[PORTRET: (.*?)\]', sheet_text, re.IGNORECASE)
+        if portrait_match:
+            character['portrait_prompt'] = portrait_match.group(1)
+    except Exception:
+        return None
+    return character
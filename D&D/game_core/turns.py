@@ -0,0 +1,228 @@
+"""Logika tury MG bez Streamlit: kolejka akcji z dzierżawą tury, prompty i zapis skutków odpowiedzi jedną transakcją."""
+import re
+from datetime import datetime, timedelta, timezone
+
+from .clients import firestore
+from .combat import describe_combat, start_combat
+from .party import character_ref, inventory_entry, party_ref
+from .rules import level_for_xp
+
+TURN_LEASE_SECONDS = 180    # po tym czasie turę porzuconą przez zerwaną sesję może przejąć inna
+TURN_RENEW_SECONDS = 60     # co ile trwająca tura (strumieniowanie MG) przedłuża swoją dzierżawę
+MAX_COALESCED_ACTIONS = 20  # ile oczekujących akcji graczy łączymy w jeden prompt
+
+
+DM_SYSTEM_PROMPT = "Jesteś Mistrzem Gry D&D. Prowadź narrację. Używaj tagów: `[IMG: opis sceny]`, `[TLO: lokacja]`, `[ZADANIE: cel misji]`, `[WYBÓR: \"Opcja 1\"; \"Opcja 2\"]`, `[XP: imie_postaci;ilość]`, `[LOOT: imie_postaci;nazwa;opis]`, `[NPC: imię;opis;prompt portretu]`, `[NPC_REMOVE: imię]`. Aby rozpocząć walkę, użyj `[WALKA: START;potwór1;potwór2;...]`. Aby zakończyć `[WALKA: KONIEC]`. Ataki, obrażenia i ruchy potworów w walce rozstrzyga silnik gry - Ty je tylko opisujesz."
+
+
+class StaleCombatRound(RuntimeError):
+    """Runda rozstrzygnięta ze stanu walki, który w międzyczasie się zmienił - jej wynik nie może zostać zapisany."""
+
+
+def sanitize_doc_id(name):
+    return re.sub(r'[/]', '-', name)
+
+
+def system_message(content):
+    return {"role": "system", "content": content, "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "System"}
+
+
+class TurnCommit:
+    """Wszystkie mutacje stanu z jednej odpowiedzi MG (nagrody, PD i awanse, NPC, walka, dokument gry) w jednej transakcji.
+
+    Indeks postać→konto budujemy raz na turę, a awanse liczymy w pamięci z XP_THRESHOLDS na danych odczytanych
+    w tej samej transakcji - równoległe przyznania PD nie przeskoczą progów poziomu. Łupy i PD trafiają też
+    do state/party w tej samej transakcji. W walce dochodzi wynik rundy z silnika walki (combat_round):
+    PŻ graczy, dziennik rundy i nowy stan walki - czyli jeden zapis na rundę.
+    """
+    def __init__(self, db, metrics, game_ref, party, live_ref, combat_round=None):
+        self.db, self.metrics = db, metrics
+        self.game_ref = game_ref
+        self.live_ref = live_ref
+        self.party = party
+        self.combat_round = combat_round
+        self.accounts = {member["name"]: member["account"] for member in party}
+
+    def commit(self, reply):
+        transactional_apply = firestore.transactional(lambda transaction: self._apply(transaction, reply))
+        with self.metrics.span("reward_writes"):
+            transactional_apply(self.db.transaction())
+
+    def _apply(self, transaction, reply):
+        if self.combat_round:
+            combat = (self.game_ref.get(transaction=transaction).to_dict() or {}).get("combat") or {}
+            if combat.get("round") != self.combat_round.round:
+                raise StaleCombatRound(f"runda {self.combat_round.round} rozstrzygnięta, a gra jest w rundzie {combat.get('round')}")
+        xp_refs = {xp["player"]: character_ref(self.db, self.accounts[xp["player"]], xp["player"]) for xp in reply.xp_awards if xp["player"] in self.accounts}
+        sheets = {snap.reference.path: snap for snap in transaction.get_all(list(xp_refs.values()))} if xp_refs else {}
+
+        # Od tego miejsca same zapisy - transakcja Firestore wymaga odczytów przed zapisami.
+        game_update, notices, party_update = {"is_typing": None}, [], {}
+        if reply.bg_keyword: game_update["background_keyword"] = reply.bg_keyword
+        if reply.quest_update: game_update["quest_log"] = reply.quest_update
+        if reply.choices: game_update["choices"] = reply.choices
+
+        for loot in reply.loot_items:
+            if loot["player"] not in self.accounts: continue
+            inventory_ref = character_ref(self.db, self.accounts[loot["player"]], loot["player"]).collection("inventory").document()
+            item_data = {"item_name": loot["item"], "description": loot["desc"]}
+            transaction.set(inventory_ref, item_data)
+            party_update.setdefault(loot["player"], {}).setdefault("inventory", []).append(inventory_entry(inventory_ref.id, item_data))
+            notices.append(f"*{loot['player']} otrzymuje: {loot['item']}!*")
+
+        progress = {}
+        for xp in reply.xp_awards:
+            snap = sheets.get(xp_refs[xp["player"]].path) if xp["player"] in xp_refs else None
+            if snap is None or not snap.exists: continue
+            sheet = snap.to_dict()
+            state = progress.setdefault(xp["player"], {"xp": sheet.get("xp", 0), "level": sheet.get("level", 1)})
+            state["xp"] += xp["amount"]
+            notices.append(f"*{xp['player']} otrzymuje {xp['amount']} PD!*")
+            new_level = level_for_xp(state["xp"], state["level"])
+            for level in range(state["level"] + 1, new_level + 1):
+                notices.append(f"🎉 **{xp['player']} awansuje na poziom {level}!** 🎉")
+            state["level"] = new_level
+        for name, state in progress.items():
+            transaction.update(xp_refs[name], state)
+            party_update.setdefault(name, {}).update(state)
+        if self.combat_round:
+            self._apply_combat_round(transaction, game_update, notices, party_update)
+        for member_update in party_update.values():
+            if "inventory" in member_update: member_update["inventory"] = firestore.ArrayUnion(member_update["inventory"])
+        if party_update:
+            transaction.set(party_ref(self.game_ref), {"members": party_update}, merge=True)
+
+        for npc_data in reply.npcs:
+            # merge=True: portret z równoległego zadania mógł już trafić do dokumentu NPC
+            transaction.set(self.game_ref.collection("npcs").document(sanitize_doc_id(npc_data['name'])), npc_data, merge=True)
+        for npc_name in reply.removed_npcs:
+            transaction.delete(self.game_ref.collection("npcs").document(sanitize_doc_id(npc_name)))
+
+        for parts in (update.split(';') for update in reply.combat_updates):
+            command = parts[0].upper()
+            if command == "START":
+                combat_state = start_combat(self.party, parts[1:], seed=self.live_ref.id)
+                game_update.update({"in_combat": True, "background_keyword": "walka", "combat": combat_state})
+                notices.append("⚔️ **Walka!** Kolejność inicjatywy: " + ", ".join(c["name"] for c in combat_state["order"]))
+            elif command == "KONIEC":
+                game_update.update({"in_combat": False, "combat": firestore.DELETE_FIELD})
+
+        transaction.update(self.live_ref, {"content": reply.narrative, "streaming": False})
+        transaction.update(self.game_ref, game_update)
+        # Wszystkie komunikaty tury mają ten sam znacznik czasu - kolejność w kronice ustala rosnące ID.
+        for i, notice in enumerate(notices):
+            transaction.set(self.game_ref.collection("messages").document(f"{self.live_ref.id}-{i:03d}"), system_message(notice))
+
+    def _apply_combat_round(self, transaction, game_update, notices, party_update):
+        result = self.combat_round
+        for name, hp in result.player_hp.items():
+            if name not in self.accounts: continue  # postać opuściła grę w trakcie walki
+            transaction.update(self.game_ref.collection("players").document(name), {"current_hp": hp})
+            party_update.setdefault(name, {})["current_hp"] = hp
+        notices.insert(0, "\n\n".join(result.log))
+        if result.state:
+            game_update["combat"] = result.state
+        else:
+            game_update.update({"in_combat": False, "combat": firestore.DELETE_FIELD})
+            notices.insert(1, f"⚔️ **Koniec walki: {result.outcome}.**")
+
+
+def enqueue_action(db, game_ref, player_name, content):
+    """Wiadomość gracza i wpis w kolejce akcji gry w jednym zapisie."""
+    batch = db.batch()
+    batch.set(game_ref.collection("messages").document(), {"role": "user", "content": content, "timestamp": firestore.SERVER_TIMESTAMP, "player_name": player_name})
+    batch.set(game_ref.collection("action_queue").document(), {"player_name": player_name, "content": content, "enqueued_at": firestore.SERVER_TIMESTAMP})
+    batch.update(game_ref, {"choices": []})
+    batch.commit()
+
+
+def turn_lease_expired(claimed_at):
+    return claimed_at is None or datetime.now(timezone.utc) - claimed_at > timedelta(seconds=TURN_LEASE_SECONDS)
+
+
+def claim_turn(db, game_ref, token):
+    """Transakcyjnie przejmuje turę MG dla tej sesji; False, gdy inna sesja już ją prowadzi."""
+    @firestore.transactional
+    def claim(transaction):
+        game = game_ref.get(transaction=transaction).to_dict() or {}
+        if game.get("turn_owner") and not turn_lease_expired(game.get("turn_claimed_at")): return False
+        transaction.update(game_ref, {"turn_owner": token, "turn_claimed_at": firestore.SERVER_TIMESTAMP, "is_typing": "Mistrz Gry"})
+        return True
+    return claim(db.transaction())
+
+
+def renew_turn(db, game_ref, token):
+    """Przedłuża dzierżawę tury trwającej dłużej niż TURN_RENEW_SECONDS; False, gdy turę przejęła już inna sesja."""
+    @firestore.transactional
+    def renew(transaction):
+        if (game_ref.get(transaction=transaction).to_dict() or {}).get("turn_owner") != token: return False
+        transaction.update(game_ref, {"turn_claimed_at": firestore.SERVER_TIMESTAMP})
+        return True
+    return renew(db.transaction())
+
+
+def release_turn(db, game_ref, token):
+    """Oddaje turę, o ile kolejka jest pusta; w przeciwnym razie przedłuża ją i zwraca False (kolejna runda dla tej sesji)."""
+    queue_probe = game_ref.collection("action_queue").limit(1)
+    @firestore.transactional
+    def release(transaction):
+        game = game_ref.get(transaction=transaction).to_dict() or {}
+        if game.get("turn_owner") != token: return True  # dzierżawa wygasła i turę przejęła inna sesja
+        if list(transaction.get(queue_probe)):
+            transaction.update(game_ref, {"turn_claimed_at": firestore.SERVER_TIMESTAMP, "is_typing": "Mistrz Gry"})
+            return False
+        transaction.update(game_ref, {"turn_owner": None, "is_typing": None})
+        return True
+    return release(db.transaction())
+
+
+def abandon_turn(db, game_ref, token):
+    @firestore.transactional
+    def abandon(transaction):
+        if (game_ref.get(transaction=transaction).to_dict() or {}).get("turn_owner") == token:
+            transaction.update(game_ref, {"turn_owner": None, "is_typing": None})
+    abandon(db.transaction())
+
+
+def drain_action_queue(db, game_ref):
+    docs = list(game_ref.collection("action_queue").order_by("enqueued_at").limit(MAX_COALESCED_ACTIONS).stream())
+    if docs:
+        batch = db.batch()
+        for doc in docs: batch.delete(doc.reference)
+        batch.commit()
+    return [doc.to_dict() for doc in docs]
+
+
+def requeue_actions(db, game_ref, actions):
+    """Oddaje pobrane akcje do kolejki (z pierwotnym czasem), gdy MG nie mógł na nie odpowiedzieć."""
+    if not actions: return
+    batch = db.batch()
+    for action in actions: batch.set(game_ref.collection("action_queue").document(), action)
+    batch.commit()
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 4  # ~4 znaki na token wystarczają do pilnowania budżetu
+
+
+def to_ai_message(msg):
+    ai_content = f"{msg.get('player_name', '')}: {msg.get('content', '')}" if msg.get('role') == 'user' else msg.get('content', '')
+    return {"role": msg.get('role', 'user'), "content": ai_content}
+
+
+def describe_game_state(game_data, party, npcs):
+    """Zwięzły stan gry dla MG: zadanie, walka, drużyna (klasa, poziom, HP) i NPC w pobliżu."""
+    lines = [f"Zadanie: {game_data.get('quest_log', 'brak')}", f"Walka: {'trwa' if game_data.get('in_combat') else 'nie'}"]
+    lines.append("Drużyna: " + "; ".join(f"{m['name']} ({m.get('klasa') or '?'}, poziom {m.get('level', 1)}, HP {m['current_hp']})" for m in party))
+    if game_data.get("combat"): lines.append(f"Runda walki {game_data['combat']['round']}: " + "; ".join(describe_combat(game_data["combat"])))
+    if npcs: lines.append("NPC w pobliżu: " + ", ".join(npc.to_dict().get('name', npc.id) for npc in npcs))
+    return "\n".join(lines)
+
+
+def combat_narration_prompt(combat_round, actions):
+    """Krótki prompt MG w walce: akcje graczy i dziennik rundy z silnika walki."""
+    instructions = "Jesteś Mistrzem Gry D&D. Opisz barwnie jedną rundę walki w 3-5 zdaniach, trzymając się dziennika rundy. Wyniki rzutów i obrażenia są ostateczne - nie zmieniaj ich, nie dodawaj wrogów i nie używaj tagów."
+    if combat_round.outcome: instructions += f" Walka właśnie się skończyła ({combat_round.outcome}) - zamknij scenę."
+    pending = "\n".join(f"{a.get('player_name')}: {a.get('content')}" for a in actions)
+    return [{"role": "system", "content": instructions},
+            {"role": "user", "content": f"Akcje graczy:\n{pending}\n\nDziennik rundy:\n" + "\n".join(combat_round.log)}]
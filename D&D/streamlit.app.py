@@ -1,14 +1,28 @@
 import streamlit as st
-import openai
 import time
-import re
-from google.cloud import firestore
-from google.oauth2 import service_account
-import json
 import random
 import string
 import streamlit.components.v1 as components
 import base64
+import contextlib
+import functools
+import os
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from game_core.chapters import archived_after, archived_before, compact_messages
+from game_core.character_pool import CharacterPoolProducer, claim_character
+from game_core.clients import LazyClient, connect_firestore, connect_openai, firestore
+from game_core.combat import resolve_round, roll
+from game_core.dm_parser import DMReply, StreamingTagParser, parse_response_from_dm, tag_name
+from game_core.image_store import ImageStore, LocalDirectoryBackend, is_store_ref
+from game_core.instrumentation import Metrics, active_scope, current_game, current_session, in_current_context
+from game_core.openai_pool import Lane, OpenAIBusy
+from game_core.party import drop_item, join_party, party_ref, rebuild_party_state, set_character_portrait, update_player_hp
+from game_core.rules import unlocked_skills, xp_for_next_level
+from game_core.sheets import hit_points, is_complete, normalize_sheet, parse_character_sheet
+from game_core.turns import (DM_SYSTEM_PROMPT, TURN_RENEW_SECONDS, StaleCombatRound, TurnCommit, abandon_turn, claim_turn, combat_narration_prompt, describe_game_state,
+                             drain_action_queue, enqueue_action, estimate_tokens, release_turn, renew_turn, requeue_actions, sanitize_doc_id, to_ai_message)
 
 # --- 1. Konfiguracja strony ---
 st.set_page_config(
@@ -26,48 +40,120 @@ AMBIANCE = {
     "default": {"video": "https://cdn.pixabay.com/video/2023/06/20/170942-838735238_large.mp4", "music": "https://cdn.pixabay.com/download/audio/2022/10/18/audio_7303a72b8b.mp3"}
 }
 
-# --- Mechaniki Gry: Poziomy i Umiejętności ---
-XP_THRESHOLDS = {1: 0, 2: 300, 3: 900, 4: 2700, 5: 6500}
-CLASS_SKILLS = {
-    "Łotrzyk": {3: ["Atak z zaskoczenia"]}, "Mag": {3: ["Kula ognia"]},
-    "Wojownik": {3: ["Drugi oddech"]}, "Kleryk": {3: ["Leczenie ran"]}
-}
+# --- Obrazy: trwały magazyn adresowany treścią ---
+IMAGE_MODEL = "dall-e-3"
+IMAGE_STORE_MAX_BYTES = 2 * 1024 ** 3  # po przekroczeniu usuwamy najdawniej używane obrazy
+IMAGE_MEMORY_MAX_BYTES = 64 * 1024 ** 2  # ile bajtów obrazów trzymamy w pamięci procesu (reszta czytana z dysku)
+PORTRAIT_PLACEHOLDER_URL = "https://placehold.co/512x512/333/FFF?text=Brak+Portretu"
+
+# --- Kronika: rozmiar okna i strony wczytywania ---
+CHAT_WINDOW = 50  # ile ostatnich wiadomości renderujemy naraz
+CHAT_PAGE = 50    # ile starszych wiadomości dociągamy po kliknięciu "Wczytaj starsze"
+STREAMING_RECHECK_TAIL = 5  # ile ostatnich wiadomości sprawdzamy pod kątem niedokończonej narracji MG
+
+# --- Odświeżanie: nasłuch zmian (listener) albo stare odpytywanie co 10 s (polling) ---
+WATCH_AREAS = ("game", "messages", "party", "npcs")
+WATCH_CHECK_SECONDS = 1  # jak często fragment watch_game_changes sprawdza kolejkę zmian w pamięci (bez odczytów z Firestore)
+WATCH_STREAMING_RERUN_SECONDS = 3  # gdy MG pisze na żywo, nowe fragmenty narracji przerysowują aplikację najwyżej raz na tyle sekund
+MAX_GAME_WATCHERS = 200      # gry z otwartymi nasłuchami w procesie; najdawniej używane są zamykane
+GAME_WATCHER_TTL = "6h"      # po tym czasie nasłuchy gry są otwierane od nowa (zamknięte przez on_release)
+POLLING_INTERVAL_SECONDS = 10
+
+# --- Tura MG: współbieżne efekty odpowiedzi ---
+TURN_PIPELINE_WORKERS = 6  # górny limit równoległych generacji obrazów na cały proces
+STREAM_FLUSH_SECONDS = 1  # co ile zapisujemy fragment narracji na żywo (Firestore: ~1 zapis/s na dokument)
+COMBAT_NARRATION_MAX_TOKENS = 250  # w walce MG tylko opisuje rundę rozstrzygniętą przez silnik walki
+
+# --- Pula gotowych postaci: kreator bez czekania na GPT-4 i DALL-E ---
+CHARACTER_POOL_CLASSES = ("Łotrzyk", "Mag", "Wojownik", "Kleryk")
+CHARACTER_POOL_TARGET = 3             # tyle gotowych kart (z portretem) na klasę utrzymuje producent w tle
+CHARACTER_POOL_REFILL_SECONDS = 300   # co ile producent sprawdza stan puli, gdy nikt jej nie uszczuplił
+CHARACTER_FALLBACK_ATTEMPTS = 3       # równoległe próby GPT-4, gdy w puli nie ma pasującej postaci
+
+# --- OpenAI: wspólna pula połączeń, limity tempa i kolejka dla całego procesu ---
+OPENAI_MAX_CONNECTIONS = 32       # połączenia keep-alive współdzielone przez wszystkie sesje
+OPENAI_TIMEOUT_SECONDS = 120      # strumień narracji MG potrafi trwać ponad minutę
+OPENAI_CHAT_RPM, OPENAI_CHAT_BURST, OPENAI_CHAT_CONCURRENCY = 300, 20, 16
+OPENAI_IMAGE_RPM, OPENAI_IMAGE_BURST, OPENAI_IMAGE_CONCURRENCY = 50, 5, TURN_PIPELINE_WORKERS
+OPENAI_MAX_WAITING = 64           # więcej oczekujących na pas = od razu OpenAIBusy zamiast rosnących opóźnień
+OPENAI_WAIT_TIMEOUT_SECONDS = 90  # maks. czas czekania na wolne miejsce w pasie
+OPENAI_MAX_RETRIES = 4            # ponowienia przy 429/5xx i zerwanym połączeniu
+
+# --- Kontekst MG: budżet tokenów i streszczenie "dotychczasowej historii" ---
+DM_MODEL = "gpt-4-turbo"
+CONTEXT_TOKEN_BUDGET = 3000  # ile tokenów najnowszej historii trafia do promptu MG
+CONTEXT_FETCH_LIMIT = 60     # maks. liczba najnowszych wiadomości czytanych przy budowie kontekstu
+SUMMARY_THRESHOLD = 40       # tyle niestreszczonych wiadomości poza oknem uruchamia odświeżenie streszczenia
+SUMMARY_BATCH_LIMIT = 200    # maks. liczba wiadomości wciąganych do streszczenia za jednym razem
+
+# --- Rozdziały: kompaktowanie starych wiadomości ---
+COMPACTION_KEEP_LOOSE = 60  # tyle najnowszych wiadomości zostaje osobnymi dokumentami (okno czatu i kontekstu MG)
+COMPACTION_MIN_BATCH = 40   # kompaktujemy, gdy poza tym ogonem uzbiera się co najmniej tyle wiadomości
+
+# Komponent montuje się raz na sesję; przy kolejnych przebiegach dostaje tylko argumenty i podmienia źródła, gdy zmieni się słowo kluczowe.
+ambiance_component = components.declare_component("ambiance", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ambiance_component"))
 
 def set_ambiance(keyword):
-    """Ustawia dynamiczne tło i muzykę."""
-    ambiance_data = AMBIANCE.get(keyword, AMBIANCE["default"])
-    video_url, music_url = ambiance_data["video"], ambiance_data["music"]
-    audio_key = f"audio_{keyword}"
-    ambiance_html = f"""
-    <style>
-    .stApp {{ background: #000; }}
-    #bg-video {{ position: fixed; right: 0; bottom: 0; min-width: 100%; min-height: 100%; z-index: -1; filter: brightness(0.5) blur(2px); }}
-    [data-testid="stSidebar"], .main .block-container {{ background-color: rgba(14, 17, 23, 0.75); backdrop-filter: blur(10px); border: 1px solid rgba(255, 255, 255, 0.1); border-radius: 10px; padding: 1rem; }}
-    [data-testid="stChatMessage"] {{ background-color: rgba(30, 35, 45, 0.9); border-radius: 10px; }}
-    </style>
-    <video autoplay loop muted playsinline id="bg-video"><source src="{video_url}" type="video/mp4"></video>
-    <audio id="{audio_key}" src="{music_url}" autoplay loop></audio>
-    """
-    components.html(ambiance_html, height=0)
+    """Ustawia dynamiczne tło i muzykę (wideo i audio pobierane tylko przy zmianie lokacji)."""
+    ambiance_component(variants=AMBIANCE, keyword=keyword if keyword in AMBIANCE else "default",
+                       dice=st.session_state.get("dice_rolls", 0), key="ambiance", default=None)
 
 def play_dice_sound():
-    components.html("""<script src="https://cdnjs.cloudflare.com/ajax/libs/tone/14.8.49/Tone.js"></script><script>const s=new Tone.Synth().toDestination();s.triggerAttackRelease("C5","16n",Tone.now()),s.triggerAttackRelease("G4","16n",Tone.now()+0.1);</script>""", height=0)
+    """Dźwięk rzutu odtwarza komponent tła przy najbliższym przebiegu - Tone.js wczytuje raz na sesję."""
+    st.session_state["dice_rolls"] = st.session_state.get("dice_rolls", 0) + 1
+
+@st.cache_resource
+def get_metrics():
+    """Liczniki procesu; ścieżki eksportu (JSONL, plik dla kolektora textfile Prometheusa) opcjonalnie z secrets."""
+    return Metrics(jsonl_path=st.secrets.get("metrics_jsonl_path"), prometheus_path=st.secrets.get("metrics_prometheus_path"))
+
+@contextlib.contextmanager
+def metrics_context(kind):
+    """Przypisanie pomiarów: sesja przeglądarki i gra; zakres `kind` zbiera operacje całego bloku."""
+    current_session.set(st.session_state.setdefault("session_token", uuid.uuid4().hex))
+    current_game.set(st.session_state.game_id)
+    scope = None
+    try:
+        with get_metrics().scope(kind) as scope:
+            yield scope
+    finally:
+        if scope is not None: st.session_state[f"last_{kind}_metrics"] = scope.to_record()
+
+def metered_fragment(fn):
+    """Fragment przerysowywany samodzielnie działa w nowym wątku z pustymi contextvars - ustawia je sam (zakres "fragment")."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if active_scope() is not None: return fn(*args, **kwargs)  # część pełnego przebiegu - liczy się w zakresie "rerun"
+        with metrics_context("fragment"):
+            return fn(*args, **kwargs)
+    return wrapper
 
 @st.cache_resource
 def get_db_connection():
     try:
-        creds_json = dict(st.secrets["firebase_credentials"])
-        creds = service_account.Credentials.from_service_account_info(creds_json)
-        return firestore.Client(credentials=creds, project=creds_json['project_id'])
+        return connect_firestore(dict(st.secrets["firebase_credentials"]), get_metrics())
     except Exception as e:
         st.error(f"Błąd połączenia z Firebase: {e}"); st.stop()
 
-db = get_db_connection()
-
-try:
-    openai.api_key = st.secrets["OPENAI_API_KEY"]
-except (KeyError, FileNotFoundError):
-    st.error("Brak klucza API OpenAI."); st.stop()
+@st.cache_resource
+def get_openai_pool():
+    try:
+        api_key = st.secrets["OPENAI_API_KEY"]
+    except (KeyError, FileNotFoundError):
+        st.error("Brak klucza API OpenAI."); st.stop()
+    return connect_openai(
+        api_key, get_metrics(),
+        Lane("czat", OPENAI_CHAT_RPM, OPENAI_CHAT_BURST, OPENAI_CHAT_CONCURRENCY, OPENAI_MAX_WAITING, OPENAI_WAIT_TIMEOUT_SECONDS),
+        Lane("obrazy", OPENAI_IMAGE_RPM, OPENAI_IMAGE_BURST, OPENAI_IMAGE_CONCURRENCY, OPENAI_MAX_WAITING, OPENAI_WAIT_TIMEOUT_SECONDS),
+        OPENAI_MAX_CONNECTIONS, OPENAI_TIMEOUT_SECONDS, OPENAI_MAX_RETRIES)
+
+# SDK i połączenia powstają przy pierwszym użyciu - ekran logowania renderuje się bez Firestore i OpenAI.
+db = LazyClient(get_db_connection)
+ai = LazyClient(get_openai_pool)
+
+UPDATE_MODE = st.secrets.get("update_mode", "listener")
+DEBUG_METRICS = st.secrets.get("debug_metrics", False)  # panel metryk w pasku bocznym
+IMAGE_STORE_DIR = st.secrets.get("image_store_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".image_store"))
 
 for key in ["player_name", "selected_character_name", "game_id"]:
     if key not in st.session_state: st.session_state[key] = None
@@ -77,72 +163,149 @@ for key in ["player_name", "selected_character_name", "game_id"]:
 def generate_game_id(length=6):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
-def parse_response_from_dm(text):
-    narrative = text
-    img_prompt, bg_keyword, map_prompt, quest_update = None, None, None, None
-    loot_items, xp_awards, choices, npcs, removed_npcs, combat_updates = [], [], [], [], [], []
-    
-    tags_to_remove = []
-    
-    img_match = re.search(r'\[IMG: (.*?)\]', text, re.DOTALL | re.IGNORECASE)
-    if img_match: img_prompt = img_match.group(1).strip(); tags_to_remove.append(img_match.group(0))
+def with_queue_depth(text, lane):
+    waiting = ai.load()[lane]["waiting"]
+    return f"{text} (w kolejce do AI: {waiting})" if waiting else text
 
-    bg_match = re.search(r'\[TLO: (.*?)\]', text, re.DOTALL | re.IGNORECASE)
-    if bg_match: bg_keyword = bg_match.group(1).strip().lower(); tags_to_remove.append(bg_match.group(0))
+def render_ai_queue_status():
+    """Widoczna presja na OpenAI: ile zapytań z całego procesu czeka na miejsce w pasie czatu i obrazów."""
+    load = ai.load()
+    if any(lane["waiting"] for lane in load.values()):
+        st.sidebar.caption(f"⏳ Kolejka AI - czat: {load['chat']['waiting']}, obrazy: {load['images']['waiting']}")
 
-    map_match = re.search(r'\[MAPA: (.*?)\]', text, re.DOTALL | re.IGNORECASE)
-    if map_match: map_prompt = map_match.group(1).strip(); tags_to_remove.append(map_match.group(0))
+@st.cache_resource
+def get_image_store():
+    return ImageStore(LocalDirectoryBackend(IMAGE_STORE_DIR), IMAGE_STORE_MAX_BYTES, IMAGE_MEMORY_MAX_BYTES)
 
-    quest_match = re.search(r'\[ZADANIE: (.*?)\]', text, re.DOTALL | re.IGNORECASE)
-    if quest_match: quest_update = quest_match.group(1).strip(); tags_to_remove.append(quest_match.group(0))
-    
-    choice_match = re.search(r'\[WYBÓR: (.*?)\]', text, re.DOTALL | re.IGNORECASE)
-    if choice_match: choices = [c.strip().strip('"') for c in choice_match.group(1).split(';')]; tags_to_remove.append(choice_match.group(0))
-
-    for tag_type, pattern, storage in [("LOOT", r'\[LOOT: (.*?);(.*?);(.*?)\]', loot_items), ("XP", r'\[XP: (.*?);(\d+)\]', xp_awards), ("NPC", r'\[NPC: (.*?);(.*?);(.*?)\]', npcs), ("NPC_REMOVE", r'\[NPC_REMOVE: (.*?)\]', removed_npcs), ("WALKA", r'\[WALKA: (.*?)\]', combat_updates)]:
-        matches = re.findall(pattern, text, re.DOTALL | re.IGNORECASE)
-        for match in matches:
-            full_tag_match = re.search(re.escape(match if isinstance(match, str) else match[0]), text)
-            if full_tag_match:
-                tags_to_remove.append(full_tag_match.group(0))
-            if tag_type == "LOOT": storage.append({"player": match[0].strip(), "item": match[1].strip(), "desc": match[2].strip()})
-            elif tag_type == "XP": storage.append({"player": match[0].strip(), "amount": int(match[1])})
-            elif tag_type == "NPC": storage.append({"name": match[0].strip(), "desc": match[1].strip(), "portrait_prompt": match[2].strip()})
-            elif tag_type == "NPC_REMOVE": storage.append(match.strip())
-            elif tag_type == "WALKA": storage.append(match.strip())
-
-    for tag in set(tags_to_remove): narrative = narrative.replace(tag, '')
-    
-    return narrative.strip(), img_prompt, bg_keyword, map_prompt, quest_update, loot_items, xp_awards, choices, npcs, removed_npcs, combat_updates
+def generate_image(prompt, size="1024x1024"):
+    """Zwraca trwałe odwołanie do obrazu; DALL-E wołamy tylko dla promptu, którego magazyn jeszcze nie zna.
 
-def parse_character_sheet(sheet_text):
-    character = {}
-    try:
-        for line in sheet_text.strip().split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                character[key.strip().lower().replace(" ", "_")] = value.strip()
-        portrait_match = re.search(r'\[PORTRET: (.*?)\]', sheet_text, re.IGNORECASE)
-        if portrait_match:
-            character['portrait_prompt'] = portrait_match.group(1)
-    except Exception:
-        return None
-    return character
+    Błędy (też OpenAIBusy i te, które zostały po ponowieniach puli) idą do wołającego - zadania tury
+    pokazują je w TurnPipeline.wait, a dotychczasowy obraz zostaje zamiast pustego.
+    """
+    def render():
+        response = ai.images.generate(model=IMAGE_MODEL, prompt=f"digital painting, {prompt}", n=1, size=size, quality="standard", response_format="b64_json")
+        return base64.b64decode(response.data[0].b64_json)
+    with get_metrics().span("image_generation"):
+        return get_image_store().get_or_generate(prompt, size, IMAGE_MODEL, render)
+
+def show_image(ref, placeholder=PORTRAIT_PLACEHOLDER_URL):
+    """Wyświetla obraz z magazynu (bajty lub stały URL), zwykły URL http albo obrazek zastępczy."""
+    image = get_image_store().resolve(ref) if is_store_ref(ref) else ref if isinstance(ref, str) and ref.startswith('http') else None
+    st.image(image or placeholder, use_container_width=True)
+
+# --- Nasłuch zmian gry ---
+class GameWatcher:
+    """Jeden zestaw nasłuchów on_snapshot na grę, współdzielony przez wszystkie sesje w procesie.
+
+    Wywołania zwrotne Firestore (z wątku w tle) zapisują najnowszy stan i podbijają licznik wersji
+    danego obszaru; sesje porównują te liczniki z ostatnio widzianymi i przerysowują tylko to, co się zmieniło.
+    """
+    def __init__(self, game_ref):
+        self._lock = threading.Lock()
+        self._first_game_snapshot, self._first_party_snapshot = threading.Event(), threading.Event()
+        self.versions = dict.fromkeys(WATCH_AREAS, 0)
+        self.closed = False
+        self.game_data, self.party_data, self.npcs = None, None, []
+        # Wiadomości czytamy kursorem (sync_messages) - nasłuch na najnowszym dokumencie wystarczy jako sygnał.
+        self._watches = [
+            game_ref.on_snapshot(self._on_game),
+            game_ref.collection("messages").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).on_snapshot(self._on_messages),
+            party_ref(game_ref).on_snapshot(self._on_party),
+            game_ref.collection("npcs").on_snapshot(self._on_npcs),
+        ]
+
+    def _bump(self, area):
+        with self._lock:
+            self.versions[area] += 1
+
+    def _on_game(self, docs, changes, read_time):
+        previous = self.game_data or {}
+        self.game_data = docs[0].to_dict() if docs and docs[0].exists else None
+        self._first_game_snapshot.set(); self._bump("game")
+        # Koniec (lub początek) tury MG: żywa narracja mogła się zmienić, choć nie jest już najnowszą wiadomością
+        # (rzut kością, akcja z kolejki) - nasłuch na limit(1) by tego nie zauważył, więc kronika się dosynchronizuje.
+        if any(previous.get(key) != (self.game_data or {}).get(key) for key in ("is_typing", "turn_owner")): self._bump("messages")
+
+    def _on_messages(self, docs, changes, read_time): self._bump("messages")
+
+    def _on_party(self, docs, changes, read_time):
+        self.party_data = docs[0].to_dict() if docs and docs[0].exists else None
+        self._first_party_snapshot.set(); self._bump("party")
+
+    def _on_npcs(self, docs, changes, read_time):
+        self.npcs = sorted(docs, key=lambda d: d.id); self._bump("npcs")
+
+    def wait_for_game(self, timeout=5):
+        self._first_game_snapshot.wait(timeout)
+        return self.game_data
+
+    def wait_for_party(self, timeout=5):
+        self._first_party_snapshot.wait(timeout)
+        return self.party_data
+
+    def snapshot_versions(self, areas):
+        with self._lock:
+            return {area: self.versions[area] for area in areas}
+
+    def close(self):
+        self.closed = True
+        for watch in self._watches: watch.unsubscribe()
+
+# Nasłuchy on_snapshot są płatne i trzymają strumień otwarty - zamykamy je, gdy cache wyrzuci lub odświeży wpis.
+@st.cache_resource(max_entries=MAX_GAME_WATCHERS, ttl=GAME_WATCHER_TTL, on_release=lambda watcher: watcher.close())
+def get_game_watcher(game_id):
+    return GameWatcher(db.collection("games").document(game_id))
+
+def mark_seen(watcher, areas):
+    """Zapamiętuje w sesji wersje obszarów, które właśnie zostały wyrenderowane."""
+    st.session_state.setdefault("seen_versions", {}).update(watcher.snapshot_versions(areas))
+
+def has_unseen_changes(watcher, areas):
+    seen = st.session_state.setdefault("seen_versions", {})
+    return any(seen.get(area) != version for area, version in watcher.snapshot_versions(areas).items())
+
+@st.fragment(run_every=WATCH_CHECK_SECONDS)
+def watch_game_changes(watcher):
+    """Lekki fragment: gdy zmieni się cokolwiek w grze (też nowa wiadomość), przerysowuje całą aplikację.
+
+    Sam niczego nie renderuje, więc bezczynna sesja co sekundę tylko porównuje liczniki - kronika
+    wysyłana jest do przeglądarki dopiero wtedy, gdy naprawdę coś się zmieniło. Podczas strumieniowania
+    narracji zmiany samych wiadomości są łączone: najwyżej jeden przebieg na WATCH_STREAMING_RERUN_SECONDS.
+    """
+    # Zamknięty nasłuch (wyrzucony z cache) już się nie zmieni - pełny przebieg pobierze nowy.
+    if watcher.closed or has_unseen_changes(watcher, ("game", "party", "npcs")): st.rerun()
+    if not has_unseen_changes(watcher, ("messages",)): return
+    streaming = (watcher.game_data or {}).get("is_typing")
+    if streaming and time.monotonic() - st.session_state.get("last_watch_rerun", 0) < WATCH_STREAMING_RERUN_SECONDS: return
+    st.session_state.last_watch_rerun = time.monotonic()
+    st.rerun()
 
-@st.cache_data(ttl=3600)
-def generate_image(prompt, size="1024x1024"):
-    try:
-        response = openai.images.generate(model="dall-e-3", prompt=f"digital painting, {prompt}", n=1, size=size, quality="standard")
-        return response.data[0].url
-    except Exception as e:
-        return None
+# --- Stan drużyny: zdenormalizowany dokument games/{id}/state/party ---
+def current_party(game_ref):
+    """Drużyna (alfabetycznie) z jednego dokumentu: z pamięci nasłuchu (tryb listener) albo jednym odczytem."""
+    if UPDATE_MODE == "listener":
+        party_data = get_game_watcher(game_ref.id).wait_for_party()
+    else:
+        snapshot = party_ref(game_ref).get()
+        party_data = snapshot.to_dict() if snapshot.exists else None
+    if party_data is None:
+        with get_metrics().span("party_rebuild"):
+            party_data = rebuild_party_state(db, game_ref)
+    return [{"name": name, **member} for name, member in sorted(party_data.get("members", {}).items())]
+
+def on_hp_input(hp_key, char_name):
+    new_hp = st.session_state[hp_key]
+    update_player_hp(db, db.collection("games").document(st.session_state.game_id), char_name, new_hp)
+    st.session_state[f"{hp_key}_seen"] = new_hp
+    st.toast(f"Zaktualizowano HP dla {char_name}!")
 
 # --- 6. Logika Gry ---
 def create_game():
     game_id = generate_game_id()
     game_ref = db.collection("games").document(game_id)
     game_ref.set({
-        "created_at": firestore.SERVER_TIMESTAMP, "active": True, "is_typing": None, "in_combat": False, "current_turn_index": 0,
+        "created_at": firestore.SERVER_TIMESTAMP, "active": True, "is_typing": None, "turn_owner": None, "in_combat": False,
         "scene_image_url": "https://placehold.co/1024x1024/0E1117/FFFFFF?text=Przygoda+si%C4%99+zaczyna...&font=raleway",
         "map_image_url": "https://placehold.co/1024x1024/0E1117/FFFFFF?text=Mapa+niezbadanych+krain...&font=raleway",
         "background_keyword": "default", "quest_log": "Twoja przygoda jeszcze się nie rozpoczęła.", "choices": []
@@ -154,128 +317,431 @@ def join_game(game_id):
     if not game_ref.get().exists:
         st.error("Gra o podanym ID nie istnieje."); return
     
-    char_ref = db.collection("players").document(st.session_state.player_name).collection("characters").document(st.session_state.selected_character_name).get()
-    if char_ref.exists:
-        char_data = char_ref.to_dict()
-        game_player_ref = game_ref.collection("players").document(st.session_state.selected_character_name)
-        game_player_ref.set({"current_hp": char_data.get("punkty_życia", "100"), "player_account": st.session_state.player_name, "joined_at": firestore.SERVER_TIMESTAMP})
+    if join_party(db, game_ref, st.session_state.player_name, st.session_state.selected_character_name):
         st.session_state.game_id = game_id
         st.rerun()
 
+def generate_character_sheet(concept):
+    """Karta postaci z GPT-4 (bez portretu) albo None, gdy odpowiedź nie zawiera wszystkich pól."""
+    prompt = f"Stwórz postać D&D na podstawie konceptu: '{concept}'. Format: Imię, Klasa, Rasa, Punkty Życia, Historia. Klasa to jedna z: {', '.join(CHARACTER_POOL_CLASSES)}. Na końcu dodaj tag [PORTRET: opis po angielsku]."
+    response = ai.chat.completions.create(model="gpt-4-turbo", messages=[{"role": "user", "content": prompt}], temperature=0.8)
+    char_data = parse_character_sheet(response.choices[0].message.content)
+    return normalize_sheet(char_data) if is_complete(char_data) else None
+
+def generate_pool_character(klasa):
+    """Kompletna karta dla puli: tekst i portret generowane w wątku producenta, poza sesjami graczy."""
+    char_data = generate_character_sheet(f"{klasa}, dowolna rasa, krótka i barwna historia")
+    if char_data: char_data["portrait_url"] = generate_image(char_data["portrait_prompt"])
+    return char_data
+
+def generate_sheet_with_retries(concept):
+    """Kilka równoległych prób GPT-4 - wygrywa pierwsza kompletna karta, reszta jest porzucana."""
+    executor = ThreadPoolExecutor(max_workers=CHARACTER_FALLBACK_ATTEMPTS, thread_name_prefix="character-sheet")
+    pending = {executor.submit(in_current_context(generate_character_sheet), concept) for _ in range(CHARACTER_FALLBACK_ATTEMPTS)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result(): return future.result()
+        return None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def store_character_portrait(character_doc_ref, prompt):
+    """Portret z tła; gracz mógł już dołączyć do gry, więc trafia też do drużyn (set_character_portrait).
+
+    Błąd generowania nie zapisuje niczego - zostaje obrazek zastępczy, a karta zachowuje portrait_prompt.
+    """
+    portrait_url = generate_image(prompt)
+    if portrait_url: set_character_portrait(db, character_doc_ref, portrait_url)
+
+@st.cache_resource
+def get_character_pool_producer():
+    """Jeden producent puli na proces (secrets: character_pool_target = 0 wyłącza pulę)."""
+    target = st.secrets.get("character_pool_target", CHARACTER_POOL_TARGET)
+    producer = CharacterPoolProducer(db, CHARACTER_POOL_CLASSES, target, generate_pool_character, CHARACTER_POOL_REFILL_SECONDS)
+    return producer.start() if target > 0 else producer
+
 def generate_character(concept):
-    with st.spinner("AI tworzy Twoją postać..."):
+    """Postać z puli (jedna transakcja) albo, gdy nic nie pasuje, świeżo wygenerowana - portret dochodzi wtedy w tle."""
+    characters_ref = db.collection("players").document(st.session_state.player_name).collection("characters")
+    producer = get_character_pool_producer()
+    try:
+        char_data = claim_character(db, concept, characters_ref)
+        if char_data:
+            producer.wake()
+        else:
+            with st.spinner(with_queue_depth("AI tworzy Twoją postać...", "chat")):
+                char_data = generate_sheet_with_retries(concept)
+            if not char_data:
+                st.error("Nie udało się wygenerować postaci. Spróbuj ponownie."); return
+            char_data['xp'] = 0; char_data['level'] = 1
+            character_doc_ref = characters_ref.document(char_data['imię'])
+            character_doc_ref.set(char_data)
+            get_turn_executor().submit(in_current_context(store_character_portrait), character_doc_ref, char_data['portrait_prompt'])
+    except OpenAIBusy:
+        st.warning("AI jest teraz przeciążone - spróbuj ponownie za chwilę."); return
+    except Exception as e:
+        st.error(f"Wystąpił błąd: {e}"); return
+    st.session_state.selected_character_name = char_data['imię']
+    st.rerun()
+
+def store_npc_portrait(game_ref, npc_data, pipeline):
+    portrait_url = generate_image(npc_data['portrait_prompt'])
+    # Portret bywa gotowy przed zapisem NPC w TurnCommit - czekamy na wynik tury; nieudana tura nie zostawia NPC-widma.
+    if portrait_url and pipeline.wait_for_commit():
+        game_ref.collection("npcs").document(sanitize_doc_id(npc_data['name'])).update({"portrait_url": portrait_url})
+
+def store_game_image(game_ref, field, prompt, size="1024x1024"):
+    image_url = generate_image(prompt, size=size)
+    if image_url: game_ref.update({field: image_url})
+
+@st.cache_resource
+def get_turn_executor():
+    """Wspólna, ograniczona pula wątków na obrazy DALL-E z tur wszystkich stołów w procesie."""
+    return ThreadPoolExecutor(max_workers=TURN_PIPELINE_WORKERS, thread_name_prefix="turn-pipeline")
+
+class TurnPipeline:
+    """Obrazy z jednej odpowiedzi MG generowane współbieżnie; każde zadanie zapisuje swój URL do Firestore, gdy tylko się skończy.
+
+    Zadania startują już w trakcie strumieniowania (on_tag), zaraz po domknięciu tagu. Mutacje stanu gry
+    zbiera i zapisuje jednym commitem TurnCommit.
+    """
+    EARLY_TAGS = ("IMG", "MAPA", "NPC")
+
+    def __init__(self, game_ref):
+        self.game_ref = game_ref
+        self.executor = get_turn_executor()
+        self.jobs = []
+        self._settled, self._committed = threading.Event(), False
+
+    def submit(self, label, fn, *args):
+        self.jobs.append((label, self.executor.submit(in_current_context(fn), self.game_ref, *args)))
+
+    def on_tag(self, tag_text):
+        if tag_name(tag_text) not in self.EARLY_TAGS: return
+        reply = parse_response_from_dm(tag_text)
+        for npc_data in reply.npcs:
+            self.submit(f"portret {npc_data['name']}", store_npc_portrait, npc_data, self)
+        if reply.img_prompt:
+            self.submit("scena", store_game_image, "scene_image_url", reply.img_prompt)
+        if reply.map_prompt:
+            self.submit("mapa", store_game_image, "map_image_url", reply.map_prompt, "1792x1024")
+
+    def settle(self, committed):
+        """Wynik tury: zadania zapisujące do dokumentów tworzonych przez TurnCommit czekają na niego (wait_for_commit)."""
+        self._committed = committed; self._settled.set()
+
+    def wait_for_commit(self):
+        self._settled.wait()
+        return self._committed
+
+    def wait(self):
+        for label, job in self.jobs:
+            try:
+                job.result()
+            except Exception as e:
+                st.warning(f"Nie udało się dokończyć: {label} ({e})")
+
+class InFlightGames:
+    """Gry, dla których w tym procesie trwa już dane zadanie w tle - drugie nie wystartuje."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._games = set()
+
+    def try_start(self, game_id):
+        with self._lock:
+            if game_id in self._games: return False
+            self._games.add(game_id); return True
+
+    def finish(self, game_id):
+        with self._lock:
+            self._games.discard(game_id)
+
+@st.cache_resource
+def get_summary_jobs():
+    return InFlightGames()
+
+def build_dm_context(game_ref, game_data, party, npcs):
+    """Najnowsze wiadomości (malejąco) w granicach CONTEXT_TOKEN_BUDGET + streszczenie starszej historii + stan gry."""
+    messages_ref = game_ref.collection("messages")
+    with get_metrics().span("history_query"):
+        newest = list(messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(CONTEXT_FETCH_LIMIT).stream())
+    window, used_tokens = [], 0
+    for doc in newest:
+        entry = to_ai_message(doc.to_dict())
+        cost = estimate_tokens(entry["content"])
+        if window and used_tokens + cost > CONTEXT_TOKEN_BUDGET: break
+        window.append((doc, entry)); used_tokens += cost
+    window.reverse()
+
+    context = [{"role": "system", "content": f"Stan gry:\n{describe_game_state(game_data, party, npcs)}"}]
+    if game_data.get("story_summary"):
+        context.append({"role": "system", "content": f"Dotychczasowa historia: {game_data['story_summary']}"})
+    context.extend(entry for _, entry in window)
+    if window and (len(window) < len(newest) or len(newest) == CONTEXT_FETCH_LIMIT):
+        maybe_refresh_story_summary(game_ref, game_data, window[0][0].to_dict().get("timestamp"))
+    return context
+
+def maybe_refresh_story_summary(game_ref, game_data, window_start):
+    """Jeśli poza oknem kontekstu zebrało się SUMMARY_THRESHOLD niestreszczonych wiadomości, odświeża streszczenie w tle."""
+    if window_start is None: return
+    unsummarized = game_ref.collection("messages").where(filter=firestore.FieldFilter("timestamp", "<", window_start))
+    if game_data.get("summary_until"):
+        unsummarized = unsummarized.where(filter=firestore.FieldFilter("timestamp", ">", game_data["summary_until"]))
+    archived_pending = game_data.get("chapters_until") and (not game_data.get("summary_until") or game_data["chapters_until"] > game_data["summary_until"])
+    if not archived_pending and unsummarized.count().get()[0][0].value < SUMMARY_THRESHOLD: return
+    summary_jobs = get_summary_jobs()
+    if not summary_jobs.try_start(game_ref.id): return
+    def run():
         try:
-            prompt = f"Stwórz postać D&D na podstawie konceptu: '{concept}'. Format: Imię, Klasa, Rasa, Punkty Życia, Historia. Na końcu dodaj tag [PORTRET: opis po angielsku]."
-            response = openai.chat.completions.create(model="gpt-4-turbo", messages=[{"role": "user", "content": prompt}], temperature=0.8)
-            sheet_text = response.choices[0].message.content
-            char_data = parse_character_sheet(sheet_text)
-            if char_data and all(k in char_data for k in ['imię', 'klasa', 'rasa', 'punkty_życia', 'historia', 'portrait_prompt']):
-                with st.spinner("AI maluje portret..."):
-                    portrait_url = generate_image(char_data['portrait_prompt'])
-                    char_data['portrait_url'] = portrait_url
-                char_data['xp'] = 0; char_data['level'] = 1
-                db.collection("players").document(st.session_state.player_name).collection("characters").document(char_data['imię']).set(char_data)
-                st.session_state.selected_character_name = char_data['imię']
-                st.rerun()
-            else:
-                st.error("Nie udało się wygenerować postaci. Spróbuj ponownie.")
-        except Exception as e:
-            st.error(f"Wystąpił błąd: {e}")
+            refresh_story_summary(game_ref, game_data, unsummarized)
+        finally:
+            summary_jobs.finish(game_ref.id)
+    get_turn_executor().submit(in_current_context(run))
+
+def refresh_story_summary(game_ref, game_data, unsummarized):
+    """Streszcza kolejną porcję historii: najpierw niestreszczone wiadomości z rozdziałów, potem luźne."""
+    summary_until, previous_summary = game_data.get("summary_until"), game_data.get("story_summary", "")
+    docs = []
+    if game_data.get("chapters_until") and (summary_until is None or game_data["chapters_until"] > summary_until):
+        docs = archived_after(game_ref, summary_until, SUMMARY_BATCH_LIMIT)
+    if len(docs) < SUMMARY_BATCH_LIMIT:
+        docs += list(unsummarized.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(SUMMARY_BATCH_LIMIT - len(docs)).stream())
+    if not docs: return
+    transcript = "\n".join(to_ai_message(doc.to_dict())["content"] for doc in docs)
+    prompt = f"Dotychczasowe streszczenie kampanii D&D:\n{previous_summary or '(brak)'}\n\nNowe wydarzenia:\n{transcript}\n\nNapisz zaktualizowane, zwięzłe streszczenie (maks. 200 słów): kluczowe wydarzenia, decyzje drużyny, otwarte wątki."
+    response = ai.chat.completions.create(model=DM_MODEL, messages=[{"role": "user", "content": prompt}], temperature=0.3)
+    game_ref.update({"story_summary": response.choices[0].message.content.strip(), "summary_until": docs[-1].to_dict().get("timestamp")})
+
+@st.cache_resource
+def get_compaction_jobs():
+    return InFlightGames()
+
+def maybe_compact_messages(game_ref):
+    """W tle przenosi stare wiadomości gry do rozdziałów (chapters.compact_messages), jeśli uzbierał się pełny rozdział."""
+    compaction_jobs = get_compaction_jobs()
+    if not compaction_jobs.try_start(game_ref.id): return
+    def run():
+        try:
+            compact_messages(db, game_ref, COMPACTION_KEEP_LOOSE, COMPACTION_MIN_BATCH)
+        finally:
+            compaction_jobs.finish(game_ref.id)
+    get_turn_executor().submit(in_current_context(run))
+
+def current_game_state(game_ref):
+    """Dokument gry i NPC - z pamięci nasłuchu (tryb listener) albo bezpośrednio z Firestore."""
+    if UPDATE_MODE == "listener":
+        watcher = get_game_watcher(game_ref.id)
+        return watcher.game_data or {}, watcher.npcs
+    return game_ref.get().to_dict() or {}, list(game_ref.collection("npcs").stream())
 
 def send_message(content, is_action=True):
+    """Zapisuje wiadomość gracza; akcje trafiają do kolejki gry, którą obsługuje naraz tylko jedna sesja."""
     game_ref = db.collection("games").document(st.session_state.game_id)
-    messages_ref = game_ref.collection("messages")
-    game_ref.update({"is_typing": st.session_state.selected_character_name, "choices": []})
-    messages_ref.add({"role": "user", "content": content, "timestamp": firestore.SERVER_TIMESTAMP, "player_name": st.session_state.selected_character_name})
     if not is_action:
-        game_ref.update({"is_typing": None}); return
-    with st.spinner("Mistrz Gry myśli..."):
-        game_ref.update({"is_typing": "Mistrz Gry"})
-        history_query = messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(20)
-        system_prompt = "Jesteś Mistrzem Gry D&D. Prowadź narrację. Używaj tagów: `[IMG: opis sceny]`, `[TLO: lokacja]`, `[ZADANIE: cel misji]`, `[WYBÓR: \"Opcja 1\"; \"Opcja 2\"]`, `[XP: imie_postaci;ilość]`, `[LOOT: imie_postaci;nazwa;opis]`, `[NPC: imię;opis;prompt portretu]`, `[NPC_REMOVE: imię]`. Aby rozpocząć walkę, użyj `[WALKA: START;potwór1;potwór2;...]`. Aby zakończyć `[WALKA: KONIEC]`. W walce, po akcji gracza, opisz co się stało i wykonaj ruch potwora."
-        messages_for_ai = [{"role": "system", "content": system_prompt}]
-        for doc in history_query.stream():
-            msg = doc.to_dict()
-            ai_content = f"{msg.get('player_name', '')}: {msg.get('content', '')}" if msg.get('role') == 'user' else msg.get('content', '')
-            messages_for_ai.append({"role": msg.get('role', 'user'), "content": ai_content})
+        game_ref.collection("messages").add({"role": "user", "content": content, "timestamp": firestore.SERVER_TIMESTAMP, "player_name": st.session_state.selected_character_name})
+        return
+    enqueue_action(db, game_ref, st.session_state.selected_character_name, content)
+    token = st.session_state.setdefault("session_token", uuid.uuid4().hex)
+    if not claim_turn(db, game_ref, token):
+        st.toast("Mistrz Gry właśnie odpowiada - Twoja akcja trafi do jego następnej odpowiedzi.")
+        return
+    # actions: pobrane z kolejki, ale jeszcze bez zapisanej odpowiedzi - przy każdym błędzie wracają do kolejki.
+    pipelines, actions = [], []
+    try:
+        while True:
+            actions = drain_action_queue(db, game_ref)
+            if actions:
+                try:
+                    with get_metrics().scope("turn") as turn_metrics: pipelines.append(run_dm_turn(game_ref, actions, token))
+                except StaleCombatRound:
+                    requeue_actions(db, game_ref, actions); actions = []
+                    continue  # ta sama sesja rozstrzygnie rundę jeszcze raz, już ze świeżego stanu
+                actions = []
+                st.session_state["last_turn_metrics"] = turn_metrics.to_record()
+            if release_turn(db, game_ref, token): break
+    except OpenAIBusy:
+        requeue_actions(db, game_ref, actions)
+        abandon_turn(db, game_ref, token)
+        st.warning("Mistrz Gry jest teraz przeciążony - spróbuj ponownie za chwilę.")
+        return
+    except Exception:
+        requeue_actions(db, game_ref, actions)
+        abandon_turn(db, game_ref, token)
+        raise
+    maybe_compact_messages(game_ref)
+    # Tura jest już oddana - obrazy dorysowują się, gdy inni gracze mogą działać dalej.
+    with st.spinner("MG maluje świat..."):
+        for pipeline in pipelines: pipeline.wait()
+
+def run_dm_turn(game_ref, actions, token):
+    """Jedno wywołanie MG odpowiadające na wszystkie zebrane akcje graczy; zwraca TurnPipeline z obrazami w toku."""
+    messages_ref = game_ref.collection("messages")
+    committed = discarded = False
+    with st.spinner(with_queue_depth("Mistrz Gry myśli...", "chat")):
+        game_data, npcs = current_game_state(game_ref)
+        # Stan walki zawsze świeży: nasłuch mógł jeszcze nie dostarczyć rundy zapisanej przed chwilą przez tę sesję.
+        game_data = game_ref.get().to_dict() or game_data
+        party = current_party(game_ref)
+        combat_round, completion_options = None, {}
+        if game_data.get("in_combat") and game_data.get("combat"):
+            # Runda walki rozstrzyga się lokalnie; MG dostaje tylko dziennik rundy do opisania, bez historii i tagów.
+            combat_round = resolve_round(game_data["combat"], actions)
+            messages_for_ai = combat_narration_prompt(combat_round, actions)
+            completion_options["max_tokens"] = COMBAT_NARRATION_MAX_TOKENS
+        else:
+            messages_for_ai = [{"role": "system", "content": DM_SYSTEM_PROMPT}] + build_dm_context(game_ref, game_data, party, npcs)
+            if len(actions) > 1:
+                pending = "; ".join(f"{a.get('player_name')}: {a.get('content')}" for a in actions)
+                messages_for_ai.append({"role": "system", "content": f"Od Twojej ostatniej odpowiedzi gracze wykonali kilka akcji ({pending}). Odpowiedz na wszystkie w jednej narracji."})
+        pipeline = TurnPipeline(game_ref)
+        # Narracja trafia do "żywej" wiadomości kawałkami, a tagi uruchamiają efekty zaraz po domknięciu.
+        live_ref = messages_ref.document()
+        live_ref.set({"role": "assistant", "content": "", "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "Mistrz Gry", "streaming": True})
+        tag_parser, raw_parts, last_flush = StreamingTagParser(), [], time.monotonic()
+        last_renewal = last_flush
         try:
-            response = openai.chat.completions.create(model="gpt-4-turbo", messages=messages_for_ai, temperature=0.9)
-            dm_response_raw = response.choices[0].message.content
-            narrative, img_prompt, bg_keyword, map_prompt, quest_update, loot_items, xp_awards, choices, npcs, removed_npcs, combat_updates = parse_response_from_dm(dm_response_raw)
-            messages_ref.add({"role": "assistant", "content": narrative, "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "Mistrz Gry"})
-            if bg_keyword: game_ref.update({"background_keyword": bg_keyword})
-            if quest_update: game_ref.update({"quest_log": quest_update})
-            if choices: game_ref.update({"choices": choices})
-            
-            for loot in loot_items:
-                game_players = game_ref.collection("players").stream()
-                for p in game_players:
-                    if p.id == loot["player"]:
-                        player_account = p.to_dict().get("player_account")
-                        db.collection("players").document(player_account).collection("characters").document(loot["player"]).collection("inventory").add({"item_name": loot["item"], "description": loot["desc"]})
-                        messages_ref.add({"role": "system", "content": f"*{loot['player']} otrzymuje: {loot['item']}!*", "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "System"})
-                        break
-            
-            for xp in xp_awards:
-                game_players = game_ref.collection("players").stream()
-                for p in game_players:
-                    if p.id == xp["player"]:
-                        player_account = p.to_dict().get("player_account")
-                        char_ref = db.collection("players").document(player_account).collection("characters").document(xp["player"])
-                        if char_ref.get().exists:
-                            char_ref.update({"xp": firestore.Increment(xp["amount"])})
-                            messages_ref.add({"role": "system", "content": f"*{xp['player']} otrzymuje {xp['amount']} PD!*", "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "System"})
-                            char_doc = char_ref.get().to_dict()
-                            current_level, current_xp = char_doc.get("level", 1), char_doc.get("xp", 0)
-                            next_level = current_level + 1
-                            if next_level in XP_THRESHOLDS and current_xp >= XP_THRESHOLDS[next_level]:
-                                char_ref.update({"level": next_level})
-                                messages_ref.add({"role": "system", "content": f"🎉 **{xp['player']} awansuje na poziom {next_level}!** 🎉", "timestamp": firestore.SERVER_TIMESTAMP, "player_name": "System"})
-                        break
-            
-            for npc_data in npcs:
-                with st.spinner(f"AI tworzy postać {npc_data['name']}..."):
-                    portrait_url = generate_image(npc_data['portrait_prompt'])
-                    npc_data['portrait_url'] = portrait_url
-                    sanitized_npc_name = re.sub(r'[/]', '-', npc_data['name'])
-                    game_ref.collection("npcs").document(sanitized_npc_name).set(npc_data)
-            
-            for npc_name in removed_npcs: 
-                sanitized_npc_name = re.sub(r'[/]', '-', npc_name)
-                game_ref.collection("npcs").document(sanitized_npc_name).delete()
-            
-            for combat_update in combat_updates:
-                parts = combat_update.split(';')
-                command = parts[0].upper()
-                if command == "START":
-                    game_ref.update({"in_combat": True, "background_keyword": "walka", "current_turn_index": 0})
-                    for doc in game_ref.collection("combatants").stream(): doc.reference.delete()
-                    for player_doc in game_ref.collection("players").stream():
-                        game_ref.collection("combatants").add({"name": player_doc.id, "type": "player", "initiative": random.randint(1,20)})
-                    for monster_name in parts[1:]:
-                        game_ref.collection("combatants").add({"name": monster_name.strip(), "type": "monster", "hp": 100, "initiative": random.randint(1,20)})
-                elif command == "KONIEC":
-                    game_ref.update({"in_combat": False})
-
-            if img_prompt:
-                with st.spinner("MG maluje scenę..."):
-                    scene_url = generate_image(img_prompt)
-                    if scene_url: game_ref.update({"scene_image_url": scene_url})
-            if map_prompt:
-                with st.spinner("MG rysuje mapę świata..."):
-                    map_url = generate_image(map_prompt, size="1792x1024")
-                    if map_url: game_ref.update({"map_image_url": map_url})
+            with st.chat_message("assistant"):
+                live_placeholder = st.empty()
+            stream = ai.chat.completions.create(model=DM_MODEL, messages=messages_for_ai, temperature=0.9, stream=True, **completion_options)
+            for chunk in stream:  # czas do pierwszego tokenu i całej generacji mierzy InstrumentedOpenAI
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta: continue
+                raw_parts.append(delta)
+                for tag_text in tag_parser.feed(delta):
+                    if combat_round is None: pipeline.on_tag(tag_text)
+                live_placeholder.markdown(tag_parser.visible)
+                if time.monotonic() - last_flush >= STREAM_FLUSH_SECONDS:
+                    live_ref.update({"content": tag_parser.visible}); last_flush = time.monotonic()
+                if time.monotonic() - last_renewal >= TURN_RENEW_SECONDS:  # długa narracja nie może stracić dzierżawy tury
+                    renew_turn(db, game_ref, token); last_renewal = time.monotonic()
+            tag_parser.close()
+            dm_response_raw = "".join(raw_parts)
+            with get_metrics().span("parse"):
+                reply = parse_response_from_dm(dm_response_raw)
+            if combat_round is not None:  # wyniki rundy są ostateczne - tagi z opisu walki pomijamy
+                reply = DMReply(narrative=reply.narrative, xp_awards=combat_round.xp_awards)
+            # Jeden commit na turę: narracja, zwolnienie "is_typing" i cały stan gry; obrazy dochodzą osobno.
+            TurnCommit(db, get_metrics(), game_ref, party, live_ref, combat_round).commit(reply)
+            committed = True
+        except StaleCombatRound:
+            discarded = True  # opis rundy, której wynik odrzuciła transakcja, nie zostaje w kronice
+            raise
         finally:
-            game_ref.update({"is_typing": None})
+            pipeline.settle(committed)
+            # Pusta wiadomość (np. OpenAIBusy przed pierwszym fragmentem) znika; urwana narracja zostaje w kronice.
+            if not committed:
+                if raw_parts and not discarded: live_ref.update({"streaming": False})
+                else: live_ref.delete()
+    return pipeline
 
 def leave_game():
     if st.session_state.game_id and st.session_state.selected_character_name:
-        player_ref = db.collection("games").document(st.session_state.game_id).collection("players").document(st.session_state.selected_character_name)
-        if player_ref.get().exists: player_ref.delete()
+        game_ref = db.collection("games").document(st.session_state.game_id)
+        player_ref = game_ref.collection("players").document(st.session_state.selected_character_name)
+        if player_ref.get().exists:
+            batch = db.batch()
+            batch.delete(player_ref)
+            batch.set(party_ref(game_ref), {"members": {st.session_state.selected_character_name: firestore.DELETE_FIELD}}, merge=True)
+            batch.commit()
+    st.session_state.get("message_cache", {}).pop(st.session_state.game_id, None)
+    st.session_state.pop("seen_versions", None)
     st.session_state.game_id = None
     st.rerun()
 
+# --- Kronika: przyrostowe wczytywanie wiadomości ---
+def get_message_cache(game_id):
+    """Zwraca pamięć podręczną kroniki tej sesji dla danej gry (tworzy ją przy pierwszym użyciu)."""
+    caches = st.session_state.setdefault("message_cache", {})
+    if game_id not in caches:
+        caches[game_id] = {"docs": [], "has_older": True, "loaded": False, "window": CHAT_WINDOW, "archive": []}
+    return caches[game_id]
+
+def sync_messages(game_doc_ref, cache):
+    """Dociąga tylko wiadomości nowsze od ostatnio widzianej (kursor start_after), więc koszt odświeżenia nie rośnie z długością gry."""
+    messages_ref = game_doc_ref.collection("messages")
+    if not cache["docs"]:
+        docs = list(messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(CHAT_WINDOW).stream())
+        docs.reverse()
+        if not cache["loaded"]: cache["has_older"] = len(docs) == CHAT_WINDOW
+        cache["loaded"] = True
+    else:
+        newer_query = messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING)
+        # Wiadomość MG generowana na żywo zmienia się po odczycie - odświeżamy ją razem z nowszymi.
+        tail_start = max(0, len(cache["docs"]) - STREAMING_RECHECK_TAIL)
+        live_index = next((i for i in range(tail_start, len(cache["docs"])) if cache["docs"][i].to_dict().get("streaming")), None)
+        if live_index is None:
+            docs = list(newer_query.start_after(cache["docs"][-1]).stream())
+        else:
+            docs = list(newer_query.start_at(cache["docs"][live_index]).stream())
+            del cache["docs"][live_index:]
+    cache["docs"].extend(docs)
+    # Okno w pamięci jest ograniczone - nadmiarowe najstarsze wpisy zawsze można dociągnąć ponownie.
+    overflow = len(cache["docs"]) - cache["window"] - CHAT_PAGE
+    if overflow > 0:
+        del cache["docs"][:overflow]; cache["has_older"] = True
+        cache["archive"] = []  # bufor rozdziału przylegał do usuniętych wpisów
+
+def load_older_messages(game_doc_ref, cache):
+    """Poszerza okno kroniki o kolejną stronę starszych wiadomości: luźnych, a gdy się skończą - z rozdziałów."""
+    cache["window"] += CHAT_PAGE
+    missing = cache["window"] - len(cache["docs"])
+    if missing <= 0 or not cache["has_older"] or not cache["docs"]: return
+    docs = []
+    if not getattr(cache["docs"][0], "archived", False):
+        older_query = game_doc_ref.collection("messages").order_by("timestamp", direction=firestore.Query.DESCENDING).start_after(cache["docs"][0]).limit(missing)
+        docs = list(older_query.stream())
+        docs.reverse()
+    need = missing - len(docs)
+    if need > 0:
+        # Rozdział czytamy w całości, a nie pokazane jeszcze starsze wiadomości czekają w buforze na kolejne strony.
+        archive = cache["archive"]
+        if len(archive) < need:
+            archive[:0] = archived_before(game_doc_ref, archive[0] if archive else docs[0] if docs else cache["docs"][0], need - len(archive))
+        taken = archive[-need:]
+        del archive[len(archive) - len(taken):]
+        docs[:0] = taken
+    cache["has_older"] = len(docs) == missing or bool(cache["archive"])
+    cache["docs"][:0] = docs
+
 # --- 7. GŁÓWNA FUNKCJA WYŚWIETLAJĄCA ---
+@st.fragment
+@metered_fragment
+def render_chronicle(game_doc_ref, watcher):
+    """Kronika jako osobny fragment - wczytanie starszych wiadomości przerysowuje tylko czat, nie całą stronę."""
+    message_cache = get_message_cache(st.session_state.game_id)
+    if watcher is None or not message_cache["loaded"] or has_unseen_changes(watcher, ("messages",)):
+        if watcher: mark_seen(watcher, ("messages",))
+        with get_metrics().span("chronicle_sync"):
+            sync_messages(game_doc_ref, message_cache)
+    if message_cache["has_older"] or len(message_cache["docs"]) > message_cache["window"]:
+        if st.button("⬆️ Wczytaj starsze wiadomości", use_container_width=True):
+            load_older_messages(game_doc_ref, message_cache)
+    chat_container = st.container()
+    with chat_container:
+        for doc in message_cache["docs"][-message_cache["window"]:]:
+            msg = doc.to_dict()
+            if 'role' in msg and msg['role'] in ['user', 'assistant', 'system']:
+                with st.chat_message(msg.get('role', 'user')):
+                    st.write(f"**{msg.get('player_name', 'Nieznany gracz')}**")
+                    st.markdown(msg.get('content', ''))
+
+def render_metrics_panel():
+    """Panel debug (secrets: debug_metrics = true): koszt ostatniego przebiegu i tury tej sesji oraz najdroższe gry procesu."""
+    metrics = get_metrics()
+    with st.sidebar.expander("🔧 Metryki (debug)"):
+        for label, key in (("Poprzedni przebieg skryptu", "last_rerun_metrics"), ("Ostatni przebieg fragmentu", "last_fragment_metrics"), ("Ostatnia tura MG", "last_turn_metrics")):
+            record = st.session_state.get(key)
+            if not record: continue
+            st.caption(f"{label}: {record['seconds']:.2f} s")
+            st.json({"operacje": record["ops"], "odcinki": record["spans"]}, expanded=False)
+        costs = metrics.cost_by_game()
+        if costs:
+            st.caption("Najdroższe gry w tym procesie")
+            st.table([{"gra": game, "odczyty": reads, "zapisy": writes, "usunięcia": deletes} for game, reads, writes, deletes in costs])
+        st.download_button("Pobierz metryki (Prometheus)", metrics.prometheus_text(), file_name="dd_metrics.prom")
+
 def main_gui():
     if not st.session_state.player_name:
         set_ambiance("default")
@@ -288,10 +754,11 @@ def main_gui():
                 st.rerun()
         return
 
-    char_collection_ref = db.collection("players").document(st.session_state.player_name).collection("characters")
-    characters = [doc.id for doc in char_collection_ref.stream()]
+    get_character_pool_producer()  # pula postaci dopełnia się w tle od pierwszego zalogowanego gracza w procesie
 
     if not st.session_state.selected_character_name:
+        char_collection_ref = db.collection("players").document(st.session_state.player_name).collection("characters")
+        characters = [doc.id for doc in char_collection_ref.stream()]
         set_ambiance("default")
         st.title(f"Witaj, {st.session_state.player_name}!")
         st.header("Wybierz lub stwórz postać")
@@ -332,7 +799,12 @@ def main_gui():
         return
 
     game_doc_ref = db.collection("games").document(st.session_state.game_id)
-    game_data = game_doc_ref.get().to_dict()
+    watcher = get_game_watcher(st.session_state.game_id) if UPDATE_MODE == "listener" else None
+    if watcher:
+        mark_seen(watcher, ("game", "party", "npcs"))
+        game_data = watcher.wait_for_game()
+    else:
+        game_data = game_doc_ref.get().to_dict()
     if not game_data:
         st.warning("Wczytywanie danych gry..."); time.sleep(2); st.rerun(); return
 
@@ -341,6 +813,7 @@ def main_gui():
 
     st.sidebar.title("Panel Gry")
     st.sidebar.markdown(f"**ID Gry:** `{st.session_state.game_id}`")
+    render_ai_queue_status()
     st.sidebar.markdown(f"**Gracz:** `{st.session_state.player_name}`")
     if st.sidebar.button("Wyjdź z gry", use_container_width=True):
         leave_game()
@@ -351,66 +824,54 @@ def main_gui():
     st.sidebar.markdown("---")
 
     with st.sidebar.expander("🗺️ Pokaż Mapę Świata"):
-        st.image(game_data.get("map_image_url", ""), use_container_width=True)
+        show_image(game_data.get("map_image_url"))
     st.sidebar.markdown("---")
     
     st.sidebar.subheader("👥 Postacie w pobliżu")
-    npcs_ref = game_doc_ref.collection("npcs").stream()
-    npcs_list = list(npcs_ref)
+    npcs_list = watcher.npcs if watcher else list(game_doc_ref.collection("npcs").stream())
     if not npcs_list: st.sidebar.caption("Nikogo tu nie ma...")
     else:
         for npc_doc in npcs_list:
             npc_data = npc_doc.to_dict()
             with st.sidebar.container():
-                portrait_url = npc_data.get('portrait_url')
-                if isinstance(portrait_url, str) and portrait_url.startswith('http'):
-                    st.image(portrait_url, use_container_width=True)
-                else:
-                    st.image("https://placehold.co/512x512/333/FFF?text=Brak+Portretu", use_container_width=True)
+                show_image(npc_data.get('portrait_url'))
                 st.write(f"**{npc_data.get('name')}**")
                 st.caption(npc_data.get('desc'))
                 if st.button(f"Porozmawiaj z {npc_data.get('name')}", key=f"talk_{npc_doc.id}", use_container_width=True):
                     send_message(f"[Rozmawia z {npc_data.get('name')}]")
                     st.rerun()
 
+    combat_state = game_data.get("combat") if game_data.get("in_combat") else None
+    if combat_state:
+        st.sidebar.markdown("---")
+        st.sidebar.subheader(f"⚔️ Walka - runda {combat_state['round']}")
+        for combatant in combat_state["order"]:
+            icon = "🛡️" if combatant["side"] == "player" else "👹"
+            st.sidebar.progress(combatant["hp"] / max(combatant["max_hp"], 1), text=f"{icon} {combatant['name']}: {combatant['hp']}/{combatant['max_hp']} PŻ")
+
     st.sidebar.markdown("---")
     st.sidebar.subheader("Drużyna")
-    game_players_ref = game_doc_ref.collection("players").stream()
-    for game_player_doc in game_players_ref:
-        char_name = game_player_doc.id
-        game_player_data = game_player_doc.to_dict()
-        player_account = game_player_data.get("player_account")
-        player_global_data = db.collection("players").document(player_account).collection("characters").document(char_name).get().to_dict() or {}
+    party = current_party(game_doc_ref)
+    for member in party:
+        char_name, player_account = member["name"], member["account"]
         with st.sidebar.expander(f"**{char_name}** ({player_account})", expanded=char_name == st.session_state.selected_character_name):
-            portrait_url = player_global_data.get('portrait_url')
-            if isinstance(portrait_url, str) and portrait_url.startswith('http'):
-                st.image(portrait_url, use_container_width=True)
-            else:
-                st.image("https://placehold.co/512x512/333/FFF?text=Brak+Portretu", use_container_width=True)
+            show_image(member.get('portrait_url'))
             
-            level = player_global_data.get('level', 1)
-            xp = player_global_data.get('xp', 0)
-            xp_for_next_level = XP_THRESHOLDS.get(level + 1, xp)
-            st.progress(xp / xp_for_next_level if xp_for_next_level > 0 else 1.0, text=f"Poziom: {level} ({xp}/{xp_for_next_level} XP)")
+            level = member.get('level', 1)
+            xp = member.get('xp', 0)
+            next_level_xp = xp_for_next_level(level, xp)
+            st.progress(xp / next_level_xp if next_level_xp > 0 else 1.0, text=f"Poziom: {level} ({xp}/{next_level_xp} XP)")
             
             hp_key = f"hp_{char_name}_{st.session_state.game_id}"
-            current_hp_str = game_player_data.get('current_hp', '0')
-            try:
-                current_hp = int(current_hp_str)
-            except (ValueError, TypeError):
-                current_hp = 0 # Default to 0 if conversion fails
+            current_hp = hit_points(member['current_hp'])
             
-            new_hp = st.number_input("Punkty Życia", value=current_hp, key=hp_key, step=1)
-            if new_hp != current_hp:
-                update_player_hp(st.session_state.game_id, char_name, new_hp)
-                st.toast(f"Zaktualizowano HP dla {char_name}!")
+            # PŻ zmienione poza polem (silnik walki, inny gracz) nadpisują wartość pola; zapisujemy tylko zmiany wpisane ręcznie.
+            if st.session_state.get(f"{hp_key}_seen") != current_hp:
+                st.session_state[hp_key] = st.session_state[f"{hp_key}_seen"] = current_hp
+            st.number_input("Punkty Życia", key=hp_key, step=1, on_change=on_hp_input, args=(hp_key, char_name))
             
             st.write("**Umiejętności:**")
-            player_class = player_global_data.get('klasa')
-            player_skills = []
-            for lvl_unlocked, skills in CLASS_SKILLS.get(player_class, {}).items():
-                if level >= lvl_unlocked:
-                    player_skills.extend(skills)
+            player_skills = unlocked_skills(member.get('klasa'), level)
             if not player_skills: st.caption("Brak")
             else:
                 for skill in player_skills:
@@ -418,18 +879,16 @@ def main_gui():
                         send_message(f"[Używa umiejętności: {skill}]"); st.rerun()
             
             st.write("**Ekwipunek:**")
-            inventory_ref = db.collection("players").document(player_account).collection("characters").document(char_name).collection("inventory").stream()
-            inventory_items = list(inventory_ref)
+            inventory_items = member["inventory"]
             if not inventory_items: st.caption("Pusto")
             else:
-                for item_doc in inventory_items:
-                    item_data = item_doc.to_dict()
-                    item_name = item_data.get('item_name', 'Nieznany przedmiot')
+                for item in inventory_items:
+                    item_name = item['item_name']
                     item_cols = st.columns([3, 1, 1]); item_cols[0].markdown(f"**{item_name}**"); 
-                    if item_cols[1].button("Użyj", key=f"use_{item_doc.id}", use_container_width=True):
+                    if item_cols[1].button("Użyj", key=f"use_{item['id']}", use_container_width=True):
                         send_message(f"[Używa: {item_name}]", is_action=True); st.rerun()
-                    if item_cols[2].button("Wyrzuć", key=f"drop_{item_doc.id}", use_container_width=True):
-                        db.collection("players").document(player_account).collection("characters").document(char_name).collection("inventory").document(item_doc.id).delete()
+                    if item_cols[2].button("Wyrzuć", key=f"drop_{item['id']}", use_container_width=True):
+                        drop_item(db, game_doc_ref, member, item)
                         send_message(f"[Wyrzuca: {item_name}]", is_action=False); st.rerun()
 
     st.sidebar.markdown("---")
@@ -437,30 +896,25 @@ def main_gui():
     dice_type = st.sidebar.selectbox("Typ kości", ["k20", "k12", "k10", "k8", "k6", "k4"])
     if st.sidebar.button(f"Rzuć {dice_type}!"):
         play_dice_sound()
-        result = random.randint(1, int(dice_type[1:]))
+        result = roll(dice_type)
         dice_roll_content = f"Rzucam kością {dice_type} i wyrzucam **{result}**."
         send_message(dice_roll_content, is_action=False)
         st.rerun()
 
+    if DEBUG_METRICS: render_metrics_panel()
+
     col1, col2 = st.columns([2, 1.2])
     with col1:
         st.header("📜 Kronika Przygody")
-        messages_query = game_doc_ref.collection("messages").order_by("timestamp", direction=firestore.Query.ASCENDING)
-        chat_container = st.container()
-        with chat_container:
-            for doc in messages_query.stream():
-                msg = doc.to_dict()
-                if 'role' in msg and msg['role'] in ['user', 'assistant', 'system']:
-                    with st.chat_message(msg.get('role', 'user')):
-                        st.write(f"**{msg.get('player_name', 'Nieznany gracz')}**")
-                        st.markdown(msg.get('content', ''))
+        render_chronicle(game_doc_ref, watcher)
     with col2:
         st.header("🎨 Wizualizacja Sceny")
-        st.image(game_data.get("scene_image_url", ""), use_container_width=True)
+        show_image(game_data.get("scene_image_url"))
         st.caption("Obraz wygenerowany przez AI na podstawie opisu Mistrza Gry.")
 
     choices = game_data.get("choices", [])
-    is_my_turn = (is_typing_by is None and not choices) or (is_typing_by is None and choices and st.session_state.selected_character_name in [p.id for p in game_doc_ref.collection("players").stream()])
+    # Gdy MG odpowiada, nowe akcje i tak trafiają do kolejki i zostaną obsłużone w jego następnej odpowiedzi.
+    is_my_turn = not choices or st.session_state.selected_character_name in [member["name"] for member in party]
 
     if choices:
         st.write("---")
@@ -471,13 +925,18 @@ def main_gui():
                 send_message(choice)
                 st.rerun()
 
-    placeholder_text = f"{is_typing_by} wykonuje ruch..." if is_typing_by else "Co robisz dalej?"
+    placeholder_text = f"{is_typing_by} wykonuje ruch... (Twoja akcja trafi do kolejki)" if is_typing_by else "Co robisz dalej?"
+    if combat_state and not is_typing_by: placeholder_text = f"Runda {combat_state['round']}: kogo atakujesz? (możesz też się leczyć lub uciekać)"
     if prompt := st.chat_input(placeholder_text, disabled=(not is_my_turn or bool(choices))):
         send_message(prompt)
         st.rerun()
 
-    time.sleep(10)
-    st.rerun()
+    if watcher:
+        watch_game_changes(watcher)
+    else:
+        time.sleep(POLLING_INTERVAL_SECONDS)
+        st.rerun()
 
 if __name__ == "__main__":
-    main_gui()
+    with metrics_context("rerun"):
+        main_gui()